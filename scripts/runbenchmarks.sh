@@ -0,0 +1,8 @@
+#!/bin/bash
+set -e
+
+source scripts/runsetup.sh
+export PYTHONPATH=$PYTHONPATH:tests
+export DJANKISERV_DATA_ROOT=./instances/djankiserv_benchmarks
+
+python src/djankiserv_cli/manage.py test --verbosity=1 --pattern="bench_*.py" tests/benchmarks/ "$@"
@@ -7,4 +7,13 @@ DJANKISERV_GUNICORN_WORKERS="${DJANKISERV_GUNICORN_WORKERS:-1}"
 DJANKISERV_LISTEN_ADDRESS="${DJANKISERV_LISTEN_ADDRESS:-127.0.0.1}"
 DJANKISERV_LISTEN_PORT="${DJANKISERV_LISTEN_PORT:-27701}"
 
-gunicorn --timeout $DJANKISERV_GUNICORN_TIMEOUT --workers=$DJANKISERV_GUNICORN_WORKERS -b $DJANKISERV_LISTEN_ADDRESS:$DJANKISERV_LISTEN_PORT djankiserv_api.wsgi
+DJANKISERV_ASGI="${DJANKISERV_ASGI:-false}"
+
+if [ "$DJANKISERV_ASGI" = "true" ]; then
+    # async sync/media views, each worker serving many clients (requires uvicorn, install djankiserv[asgi]). Under
+    # django 3.2 the body of the streamed responses (sync/download, and its gzip compression) is still read on
+    # the event loop, see djankiserv_sync.views.asynchronous
+    gunicorn --timeout $DJANKISERV_GUNICORN_TIMEOUT --workers=$DJANKISERV_GUNICORN_WORKERS -b $DJANKISERV_LISTEN_ADDRESS:$DJANKISERV_LISTEN_PORT -k uvicorn.workers.UvicornWorker djankiserv_api.asgi
+else
+    gunicorn --timeout $DJANKISERV_GUNICORN_TIMEOUT --workers=$DJANKISERV_GUNICORN_WORKERS -b $DJANKISERV_LISTEN_ADDRESS:$DJANKISERV_LISTEN_PORT djankiserv_api.wsgi
+fi
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from djankiserv_unki.mediastore import MediaStore
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the media files of existing users to the shared content-addressed media store, and remove the "
+        "stored media no user links to anymore. Run it when turning DJANKISERV_MEDIA_DEDUP on for an existing server, "
+        "and from time to time afterwards: the content of a media file replaced after a full upload (which empties "
+        "the media table, not the media directory) stays stored until then. Don't run it while media syncs are in "
+        "progress."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("usernames", nargs="*", help="only deduplicate the media of these users")
+
+    def handle(self, *args, **options):
+        data_root = settings.DJANKISERV_DATA_ROOT
+        media_store = MediaStore(os.path.join(data_root, MediaStore.DIRNAME))
+
+        usernames = options["usernames"]
+        if not usernames and os.path.isdir(data_root):
+            usernames = sorted(e.name for e in os.scandir(data_root) if e.is_dir() and e.name != MediaStore.DIRNAME)
+
+        total_files = total_bytes = 0
+        for username in usernames:
+            media_dir = os.path.join(data_root, username)
+            if not os.path.isdir(media_dir):
+                continue
+            files, saved = media_store.migrate(media_dir)
+            total_files += files
+            total_bytes += saved
+            if options["verbosity"] > 1:
+                self.stdout.write(f"{username}: {files} files, {saved} bytes deduplicated")
+
+        removed = media_store.collect_all()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Deduplicated {total_files} files ({total_bytes} bytes), removed {removed} unused stored files"
+            )
+        )
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from djankiserv_unki.collection import Collection
+from djankiserv_unki.database import StandardDB
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the media usn and count kept in the meta table of each user from their media table, reporting the "
+        "users for which they were wrong."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("usernames", nargs="*", help="only repair the media counters of these users")
+
+    def handle(self, *args, **options):
+        usernames = options["usernames"] or User.objects.order_by("username").values_list("username", flat=True)
+
+        repaired = 0
+        for username in usernames:
+            if not StandardDB.schema_exists(username):
+                continue
+            StandardDB.upgrade_schema(username)
+            db = StandardDB()
+            with db.atomic():
+                before = db.first(f"SELECT lastusn, mediacount FROM {username}.meta FOR UPDATE")
+                after = Collection.repair_media_meta(db, username)
+            if before is None or tuple(before) != tuple(after):
+                repaired += 1
+                self.stdout.write(f"{username}: (usn, count) {tuple(before) if before else None} -> {tuple(after)}")
+
+        self.stdout.write(self.style.SUCCESS(f"Repaired the media counters of {repaired} users"))
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djankiserv_api.settings")
+os.environ.setdefault("DJANKISERV_ASYNC_VIEWS", "True")  # see djankiserv_sync.views.asynchronous
+
+application = get_asgi_application()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from djankiserv_unki.cache import LRUCache
+
+# the users that recently authenticated with a username and password, see CachedModelBackend
+credentials_cache = LRUCache(max_entries=getattr(settings, "DJANKISERV_AUTH_CACHE_ENTRIES", 1000))
+
+
+def credentials_key(username, password):
+    "A keyed hash of the credentials, so neither they nor anything that can be brute-forced offline are kept"
+    return salted_hmac(
+        "djankiserv_api.auth.credentials", f"{len(username)}:{username}:{password}", algorithm="sha256"
+    ).hexdigest()
+
+
+def password_digest(user):
+    "A keyed hash of the stored password hash of `user`, that tells when it changes"
+    return salted_hmac("djankiserv_api.auth.hash", user.password, algorithm="sha256").hexdigest()
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    The django ModelBackend, which remembers a successful verification of a username and password for
+    DJANKISERV_AUTH_CACHE_TTL seconds. The password hasher takes tens of milliseconds of cpu on purpose, which
+    the api clients using basic auth would otherwise pay on every request.
+
+    A hit still reads the user by primary key, and the entry is only used while the user has the same username and
+    password hash, so changing the password (or deactivating the user) takes effect immediately, in every process:
+    that cheap SELECT replaces the hashing, not the database. The entry only keeps a keyed digest of the hash, never
+    the hash itself. Failed attempts are never cached.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        ttl = getattr(settings, "DJANKISERV_AUTH_CACHE_TTL", 60)
+        if username is None or password is None or not ttl:
+            return super().authenticate(request, username=username, password=password, **kwargs)
+
+        key = credentials_key(username, password)
+        entry = credentials_cache.get(key)
+        if entry is not None and entry["expires"] > time.time():
+            user = UserModel._default_manager.filter(pk=entry["pk"]).first()  # pylint: disable=W0212
+            if (
+                user is not None
+                and user.get_username() == username
+                and constant_time_compare(password_digest(user), entry["password"])
+                and self.user_can_authenticate(user)
+            ):
+                return user
+        if entry is not None:
+            credentials_cache.invalidate(key)
+
+        user = super().authenticate(request, username=username, password=password, **kwargs)
+        if user is not None:
+            credentials_cache.put(key, {"pk": user.pk, "password": password_digest(user), "expires": time.time() + ttl})
+        return user
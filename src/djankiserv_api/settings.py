@@ -110,6 +110,10 @@ else:
         "PORT": os.getenv("DJANKISERV_USERDB_PORT", "5432"),
     }
 
+# keep the userdata connections open between requests for this many seconds, each worker thread reusing its own
+# connection. Leave at 0 with the development server, which creates a thread per request
+DATABASES["userdata"]["CONN_MAX_AGE"] = int(os.getenv("DJANKISERV_USERDB_CONN_MAX_AGE", "0"))
+
 AUTH_PASSWORD_VALIDATORS = [
     {"NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator"},
     {"NAME": "django.contrib.auth.password_validation.MinimumLengthValidator"},
@@ -127,6 +131,13 @@ REST_FRAMEWORK = {  # this better protects the /api/* methods, the xSYNC methods
     ],
 }
 
+# both the api clients using basic auth and the sync logins check passwords with this backend, which remembers a
+# successful verification for DJANKISERV_AUTH_CACHE_TTL seconds so the password hasher doesn't run on every request
+AUTHENTICATION_BACKENDS = ["djankiserv_api.auth.CachedModelBackend"]
+# set the ttl to 0 to disable
+DJANKISERV_AUTH_CACHE_TTL = int(os.getenv("DJANKISERV_AUTH_CACHE_TTL", "60"))
+DJANKISERV_AUTH_CACHE_ENTRIES = int(os.getenv("DJANKISERV_AUTH_CACHE_ENTRIES", "1000"))
+
 LANGUAGE_CODE = "en-gb"
 TIME_ZONE = "UTC"
 USE_I18N = True
@@ -146,5 +157,68 @@ APPEND_SLASH = False
 
 DJANKISERV_DATA_ROOT = os.getenv("DJANKISERV_DATA_ROOT", "./instances/djankiserv")
 
+# store media files with the same content only once for all users, as hard links to a content-addressed store in
+# DJANKISERV_DATA_ROOT. When turning it on for an existing server, also run the `dedup_media` command (while no media
+# syncs are in progress), or only the media uploaded from then on gets deduplicated
+DJANKISERV_MEDIA_DEDUP = os.getenv("DJANKISERV_MEDIA_DEDUP", "False").lower() == "true"
+
+# threads removing the media files deleted by clients from the disk
+DJANKISERV_MEDIA_DELETE_THREADS = int(os.getenv("DJANKISERV_MEDIA_DELETE_THREADS", "4"))
+
+# threads deflating the media files (those not compressed already) of the zips sent by msync/downloadFiles
+DJANKISERV_MEDIA_ZIP_THREADS = int(os.getenv("DJANKISERV_MEDIA_ZIP_THREADS", "4"))
+
+# most media changes returned by each call to msync/mediaChanges, clients call it again until they have them all
+DJANKISERV_MEDIA_CHANGES_PAGE_SIZE = int(os.getenv("DJANKISERV_MEDIA_CHANGES_PAGE_SIZE", "1000"))
+
+# maximum number of revlog/cards/notes rows returned by each call to sync/chunk
+DJANKISERV_SYNC_CHUNK_SIZE = int(os.getenv("DJANKISERV_SYNC_CHUNK_SIZE", "250"))
+
+# serve the sync and media views as async views, running them in a pool of threads, set by djankiserv_api.asgi (which
+# is served by uvicorn, from the `asgi` extra)
+DJANKISERV_ASYNC_VIEWS = os.getenv("DJANKISERV_ASYNC_VIEWS", "False").lower() == "true"
+DJANKISERV_ASYNC_THREADS = int(os.getenv("DJANKISERV_ASYNC_THREADS", "8"))
+
+# in-process LRU of the host keys of the sync sessions, so the sync and media requests don't read them from the
+# database, set to 0 to disable
+DJANKISERV_SYNC_SESSION_CACHE_ENTRIES = int(os.getenv("DJANKISERV_SYNC_SESSION_CACHE_ENTRIES", "1000"))
+
+# a cache shared by all the server processes (memcached by default) to keep the state of the syncs in progress in,
+# rather than writing it to the database during each sync
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+DJANKISERV_SYNC_SESSION_CACHE = ""
+if os.getenv("DJANKISERV_SYNC_SESSION_CACHE_LOCATION"):
+    CACHES["sync_sessions"] = {
+        "BACKEND": os.getenv(
+            "DJANKISERV_SYNC_SESSION_CACHE_BACKEND", "django.core.cache.backends.memcached.PyMemcacheCache"
+        ),
+        "LOCATION": os.getenv("DJANKISERV_SYNC_SESSION_CACHE_LOCATION"),
+    }
+    DJANKISERV_SYNC_SESSION_CACHE = "sync_sessions"
+
+# gzip the big sync responses (start, applyChanges, chunk and the collection download) for the clients that accept
+# it, when the body has at least DJANKISERV_SYNC_GZIP_MIN_SIZE bytes. Level 1 is the fastest, 9 the smallest
+DJANKISERV_SYNC_GZIP = os.getenv("DJANKISERV_SYNC_GZIP", "True").lower() == "true"
+DJANKISERV_SYNC_GZIP_MIN_SIZE = int(os.getenv("DJANKISERV_SYNC_GZIP_MIN_SIZE", "1024"))
+DJANKISERV_SYNC_GZIP_LEVEL = int(os.getenv("DJANKISERV_SYNC_GZIP_LEVEL", "6"))
+
+# json codec of the sync and api responses and of the collection state: orjson, json (the standard library) or auto,
+# which is orjson when it is installed (the `json` extra)
+DJANKISERV_JSON_CODEC = os.getenv("DJANKISERV_JSON_CODEC", "auto")
+
+# rows per multi-row statement when writing cards/notes/revlog in bulk (merging the rows sent by clients, updating
+# the notes field cache)
+DJANKISERV_UPSERT_PAGE_SIZE = int(os.getenv("DJANKISERV_UPSERT_PAGE_SIZE", "1000"))
+
+# processes used to strip the html and checksum the fields of merged notes, when there is more than a page of them
+DJANKISERV_FIELD_CACHE_PROCESSES = int(os.getenv("DJANKISERV_FIELD_CACHE_PROCESSES", "0"))
+
+# per-process LRU cache of the parsed collection state (conf, models, decks...), set the entries to 0 to disable
+DJANKISERV_COLLECTION_CACHE_ENTRIES = int(os.getenv("DJANKISERV_COLLECTION_CACHE_ENTRIES", "100"))
+DJANKISERV_COLLECTION_CACHE_BYTES = int(os.getenv("DJANKISERV_COLLECTION_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# check that a kept userdata connection still works before a request uses it, see DJANKISERV_USERDB_CONN_MAX_AGE
+DJANKISERV_USERDB_CONN_HEALTH_CHECKS = os.getenv("DJANKISERV_USERDB_CONN_HEALTH_CHECKS", "True").lower() == "true"
+
 DJANKISERV_GENERATE_TEST_ASSETS = False
 DJANKISERV_GENERATE_TEST_ASSETS_DIR = "./instances/asrv/"
@@ -2,10 +2,13 @@
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.signals import request_started
+from django.db.backends.signals import connection_created
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 from djankiserv_unki.collection import Collection
+from djankiserv_unki.database import connection_stats, db_conn
 
 
 @receiver(post_save, sender=User)  # pylint: disable=W0613
@@ -19,3 +22,14 @@ def update_profile_signal(sender, instance, created, **kwargs):  # pylint: disab
 @receiver(post_delete, sender=User)
 def delete_user_signal(sender, instance, **kwargs):  # pylint: disable=W0613
     Collection.delete(instance.username, settings.DJANKISERV_DATA_ROOT)  # pylint: disable=W0613
+
+
+@receiver(connection_created)
+def connection_created_signal(sender, connection, **kwargs):  # pylint: disable=W0613
+    if connection.alias == db_conn().alias:
+        connection_stats.connection_created()
+
+
+@receiver(request_started)
+def request_started_signal(sender, **kwargs):  # pylint: disable=W0613
+    connection_stats.request_started()
@@ -24,6 +24,7 @@ def routes():
     routes.append(path("api/v1/decks/conf", views.get_deck_confs, name="decks_conf"))
     routes.append(path("api/v1/tags", views.tags, name="tags"))
     routes.append(path("api/v1/models", views.models, name="models"))
+    routes.append(path("api/v1/stats", views.stats, name="stats"))
     return routes
 
 
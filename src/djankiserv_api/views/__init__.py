@@ -6,4 +6,5 @@ from djankiserv_api.views.notes import delete_notes
 from djankiserv_api.views.decks import get_decks
 from djankiserv_api.views.decks import get_deck_confs
 from djankiserv_api.views.tags import tags
-from djankiserv_api.views.models import models
\ No newline at end of file
+from djankiserv_api.views.models import models
+from djankiserv_api.views.stats import stats
@@ -1,9 +1,9 @@
 
 from django.conf import settings
-from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.decorators import api_view
 
+from djankiserv_unki.codec import JsonResponse
 from djankiserv_unki.collection import Collection
 
 @csrf_exempt
@@ -1,10 +1,10 @@
 
 from django.conf import settings
-from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.decorators import api_view, parser_classes
 from rest_framework.parsers import JSONParser
 
+from djankiserv_unki.codec import JsonResponse
 from djankiserv_unki.collection import Collection
 
 @csrf_exempt
@@ -12,9 +12,7 @@ from djankiserv_unki.collection import Collection
 @parser_classes([JSONParser])
 def add_notes(request):
     with Collection(request.user.username, settings.DJANKISERV_DATA_ROOT) as col:
-        note_ids = []
-        for note in request.data["notes"]:
-            note_ids.append(col.create_note(note, deck_name=request.data["deck"]))
+        note_ids = col.create_notes(request.data["notes"], deck_name=request.data["deck"])
 
     return JsonResponse({"note_ids": note_ids})
 
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+
+from djankiserv_api.auth import credentials_cache
+from djankiserv_sync.compression import compression_stats
+from djankiserv_sync.sessions import session_cache
+from djankiserv_unki.cache import collection_cache
+from djankiserv_unki.codec import JsonResponse
+from djankiserv_unki.database import connection_stats
+
+
+@api_view(["GET"])
+@permission_classes((IsAdminUser,))
+def stats(request):  # pylint: disable=W0613
+    # per-process, so with several workers each one reports its own values
+    return JsonResponse(
+        {
+            "collection_cache": collection_cache.stats(),
+            "userdata_connections": connection_stats.stats(),
+            "sync_compression": compression_stats.stats(),
+            "sync_sessions": session_cache.stats(),
+            "auth_cache": credentials_cache.stats(),
+        }
+    )
@@ -1,26 +1,81 @@
 # -*- coding: utf-8 -*-
 
 
+import io
 import logging
 import os
+import shutil
+import sys
 import tempfile
 import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from sqlite3 import dbapi2 as sqlite
 
+from django.conf import settings
+
 import djankiserv_unki
 from djankiserv.assets import jsonfiles  # noqa: 401
-from djankiserv_unki import REM_CARD, REM_NOTE, ids2str, intTime
+from djankiserv_unki import REM_CARD, REM_NOTE, codec, intTime
+from djankiserv_unki.cache import collection_cache
 from djankiserv_unki.database import StandardDB, db_conn
 from djankiserv_unki.download import DB, sqlite3_for_download
 
 logger = logging.getLogger("djankiserv.sync")
 
+DOWNLOAD_BLOCK_SIZE = 64 * 1024
+
+# the client asks for media files in batches, we only send as many of them as fit within these limits
+SYNC_ZIP_SIZE = int(2.5 * 1024 * 1024)
+SYNC_ZIP_COUNT = 25
+# media formats that are compressed already, so deflating them again would cost a lot of cpu for nothing
+COMPRESSED_MEDIA_EXTENSIONS = {
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".gif",
+    ".webp",
+    ".mp3",
+    ".ogg",
+    ".oga",
+    ".opus",
+    ".m4a",
+    ".aac",
+    ".flac",
+    ".mp4",
+    ".webm",
+    ".mkv",
+    ".mov",
+    ".avi",
+}
+
+# deflates the media files of the download zips, zlib releases the GIL so they get compressed in parallel
+media_zip_executor = ThreadPoolExecutor(max_workers=getattr(settings, "DJANKISERV_MEDIA_ZIP_THREADS", 4))
+# writing the members deflated in parallel relies on the internals of zipfile.ZipFile (see _write_deflated_member),
+# so it is only done on the versions of python it has been checked against, zipfile deflates them serially otherwise
+PARALLEL_MEDIA_ZIP = (3, 8) <= sys.version_info[:2] <= (3, 13)
+
+
+class TemporaryDownloadFile(io.FileIO):
+    "A read-only file that is deleted when closed, so it can be handed to a streaming response."
+
+    def __init__(self, path):
+        super().__init__(path, "rb")
+
+    def close(self):
+        super().close()
+        if os.path.exists(self.name):
+            os.remove(self.name)
+
 
 class SyncCollectionHandler:  # pylint: disable=R0904
     operations = ["meta", "applyChanges", "start", "applyGraves", "chunk", "applyChunk", "sanityCheck2", "finish"]
+    chunk_tables = ["revlog", "cards", "notes"]
 
-    def __init__(self, col, session=None):
+    def __init__(self, col, session=None, chunk_size=250):
         self.col = col
+        self.chunk_size = chunk_size
         if session:
             ## make sure not to create the property if it isn't in the dict
             ## this way we know the actual flow of events as it will raise an
@@ -31,6 +86,8 @@ class SyncCollectionHandler:  # pylint: disable=R0904
                 self.max_usn = session["max_usn"]
             if "lnewer" in session:
                 self.lnewer = session["lnewer"]
+            if "chunk_cursor" in session:
+                self.chunk_cursor = session["chunk_cursor"]
 
     ##
     ## Public API methods
@@ -47,6 +104,8 @@ class SyncCollectionHandler:  # pylint: disable=R0904
         self.max_usn = self.col.usn
         self.min_usn = min_usn
         self.lnewer = not lnewer
+        # keyset cursor for `chunk`: [table still to send, last id sent from that table]
+        self.chunk_cursor = [self.chunk_tables[0], None]
         lgraves = self.removed()
         return lgraves
 
@@ -67,14 +126,36 @@ class SyncCollectionHandler:  # pylint: disable=R0904
         if "notes" in chunk:
             self.merge_notes(chunk["notes"])
 
-    def all_data_to_sync_down(self):
-        buf = dict(done=True)
-        for table in ["revlog", "cards", "notes"]:
-            cursor = self.cursor_for_table(table)
-            rows = cursor.fetchall()
-            # mark the objects as having been sent
-            self.col.db.execute(f"update {self.col.username}.{table} set usn=%s where usn=-1", self.max_usn)
+    def chunk(self):
+        """
+        Return at most `chunk_size` rows of the revlog, cards and notes that the client hasn't seen yet.
+
+        Rather than keeping a db cursor open between requests (like upstream does), we keep a keyset
+        cursor (table, last id sent) that the caller must persist between calls. The client keeps
+        calling until it gets `done=True`.
+        """
+        buf = dict(done=False)
+        lim = self.chunk_size
+        table, last_id = self.chunk_cursor
+        while table and lim:
+            rows = self.cursor_for_table(table, last_id, lim).fetchall()
+            exhausted = len(rows) != lim
+            # mark the objects as having been sent, only for the id range covered by this chunk
+            sent = "" if last_id is None else f" and id > {int(last_id)}"
+            if not exhausted:
+                sent += f" and id <= {int(rows[-1][0])}"
+            self.col.db.execute(f"update {self.col.username}.{table} set usn=%s where usn=-1{sent}", self.max_usn)
             buf[table] = rows
+            lim -= len(rows)
+            if exhausted:
+                next_idx = self.chunk_tables.index(table) + 1
+                table = self.chunk_tables[next_idx] if next_idx < len(self.chunk_tables) else None
+                last_id = None
+            else:
+                last_id = rows[-1][0]
+        self.chunk_cursor = [table, last_id]
+        if not table:
+            buf["done"] = True
         return buf
 
     def sanityCheck2(self, client):
@@ -114,11 +195,20 @@ class SyncCollectionHandler:  # pylint: disable=R0904
         if "crt" in rchg:
             self.col.crt = rchg["crt"]
 
+    def table_counts(self):
+        "Return {table: (row count, rows with usn = -1)} for the synced tables, in a single query."
+        sql = " union all ".join(
+            f"select '{t}', count(0), sum(case when usn = -1 then 1 else 0 end) from {self.col.username}.{t}"
+            for t in ("cards", "notes", "revlog", "graves")
+        )
+        return {t: (int(total), int(unsynced or 0)) for t, total, unsynced in self.col.db.execute(sql)}
+
     def sanity_check(self):  # noqa: C901
         if not self.col.basic_check():
             return "failed basic check"
+        counts = self.table_counts()
         for t in "cards", "notes", "revlog", "graves":
-            if self.col.db.scalar(f"select count(0) from {self.col.username}.{t} where usn = -1"):
+            if counts[t][1]:
                 return "%s had usn = -1" % t
         for g in self.col.decks.all():
             if g["usn"] == -1:
@@ -139,32 +229,37 @@ class SyncCollectionHandler:  # pylint: disable=R0904
         # return summary of deck
         return [
             list(self.col.sched.counts()),
-            self.col.db.scalar(f"select count(0) from {self.col.username}.cards"),
-            self.col.db.scalar(f"select count(0) from {self.col.username}.notes"),
-            self.col.db.scalar(f"select count(0) from {self.col.username}.revlog"),
-            self.col.db.scalar(f"select count(0) from {self.col.username}.graves"),
+            counts["cards"][0],
+            counts["notes"][0],
+            counts["revlog"][0],
+            counts["graves"][0],
             len(self.col.models.all()),
             len(self.col.decks.all()),
             len(self.col.decks.all_conf()),
         ]
 
-    def cursor_for_table(self, table):
+    def cursor_for_table(self, table, last_id=None, limit=None):
+        where = f"usn >= {self.min_usn}"
+        if last_id is not None:
+            where += f" and id > {int(last_id)}"
+        # keyset pagination on the primary key, so each chunk is a cheap index range scan
+        suffix = "order by id" + (f" limit {int(limit)}" if limit else "")
         if table == "revlog":
             return self.col.db.execute(
                 f"""
                 select id, cid, {self.max_usn}, ease, ivl, lastIvl, factor, rtime, type
-                from {self.col.username}.revlog where usn >= {self.min_usn}"""
+                from {self.col.username}.revlog where {where} {suffix}"""
             )
         if table == "cards":
             return self.col.db.execute(
                 f"""
                 select id, nid, did, ord, modified, {self.max_usn}, type, queue, due, ivl, factor, reps,
-                lapses, remaining, odue, odid, flags, data from {self.col.username}.cards where usn >= {self.min_usn}"""
+                lapses, remaining, odue, odid, flags, data from {self.col.username}.cards where {where} {suffix}"""
             )
         return self.col.db.execute(
             f"""
             select id, guid, mid, modified, {self.max_usn}, tags, flds, '', '', flags, data
-            from {self.col.username}.notes where usn >= {self.min_usn}"""
+            from {self.col.username}.notes where {where} {suffix}"""
         )
 
     def remove(self, graves):
@@ -206,35 +301,14 @@ class SyncCollectionHandler:  # pylint: disable=R0904
         self.col.register_tags(tags, usn=self.max_usn)
 
     def merge_revlog(self, logs):
-        # import AnkiDataModel  # noqa # pylint: disable=C0415,W0611
-        sql = djankiserv_unki.AnkiDataModel.insert_on_conflict_nothing(self.col.username, "revlog")
-
-        self.col.db.executemany(sql, logs)
-
-    def newer_rows(self, data, table, modIdx):
-        ids = (r[0] for r in data)
-        lmods = {}
-        ids_str = ids2str(ids)
-        for tid, mod in self.col.db.execute(
-            f"select id, modified from {self.col.username}.{table} where id in {ids_str} and usn >= {self.min_usn}"
-        ):
-            lmods[tid] = mod
-        update = []
-        for r in data:
-            if r[0] not in lmods or lmods[r[0]] < r[modIdx]:
-                update.append(r)
-        return update
+        self.col.db.upsert(self.col.username, "revlog", logs, update=False)
 
     def merge_cards(self, cards):
-        sql = djankiserv_unki.AnkiDataModel.insert_on_conflict_update(self.col.username, "cards")
-        rows = self.newer_rows(cards, "cards", 4)
-        self.col.db.executemany(sql, rows)
+        self.col.db.merge(self.col.username, "cards", cards, self.min_usn)
 
     def merge_notes(self, notes):
-        rows = self.newer_rows(notes, "notes", 3)
-        sql = djankiserv_unki.AnkiDataModel.insert_on_conflict_update(self.col.username, "notes")
-        self.col.db.executemany(sql, rows)
-        self.col.update_field_cache([f[0] for f in rows])
+        nids = self.col.db.merge(self.col.username, "notes", notes, self.min_usn)
+        self.col.update_field_cache(nids)
 
     def get_conf(self):
         return self.col.conf
@@ -304,17 +378,19 @@ class SyncCollectionHandler:  # pylint: disable=R0904
 
 
 def full_upload(data, username):
+    "Replace the collection of `username` with the sqlite collection in the file `data`"
     # from sqlite to a standard db
     # TODO, maybe make this from config or an envvar
     insert_cursor_size = 10000  # this has no effect on memory and less than 1k significantly increases the time
 
-    if not len(data) > 0:
-        raise Exception("There is no data in the uploaded file")
-
     # write data to a tempfile
     with tempfile.NamedTemporaryFile(suffix=".anki2", delete=False) as f:
         temp_db_path = f.name
-        f.write(data)
+        shutil.copyfileobj(data, f, DOWNLOAD_BLOCK_SIZE)
+
+    if not os.path.getsize(temp_db_path) > 0:
+        os.remove(temp_db_path)
+        raise Exception("There is no data in the uploaded file")
 
     # Verify integrity of the received database file before replacing our existing db.
     _check_sqlite3_db(temp_db_path)
@@ -336,23 +412,88 @@ def full_upload(data, username):
 
             start_sqlite_cursor = sqlite_conn.cursor()
             start_sqlite_cursor.execute(f"SELECT * FROM {table}")
-            while True:
-                current_data = start_sqlite_cursor.fetchmany(insert_cursor_size)
-                if not current_data:
-                    break
-                # FIXME: psycopg2.extras is MUCH better than executemany, but is pgsql-specific
-                # psycopg2.extras.execute_values(
-                #     to_std_cursor, f"INSERT INTO {tmp_schema_name}.{table} VALUES %s", current_data)
-
-                cols = ",".join(["%s"] * len(current_data[0]))
-                to_std_cursor.executemany(f"INSERT INTO {tmp_schema_name}.{table} VALUES ({cols})", current_data)
+            djankiserv_unki.AnkiDataModel.bulk_insert(
+                to_std_cursor, tmp_schema_name, table, start_sqlite_cursor, insert_cursor_size
+            )
             start_sqlite_cursor.close()
         djankiserv_unki.AnkiDataModel.replace_schema(to_std_cursor, username, tmp_schema_name)
+        StandardDB.forget_schema(tmp_schema_name)  # it has been renamed to `username`
+        collection_cache.invalidate(username)
         os.remove(temp_db_path)
 
     return "OK"
 
 
+def media_zip(media_dir, fnames):
+    """
+    Return a file with the zip expected by msync/downloadFiles, holding the first of the media files `fnames` up to
+    the SYNC_ZIP_* limits, and a `_meta` mapping their names in the zip to the real ones. Big zips get spooled to disk.
+
+    The files that aren't compressed already are deflated in parallel in media_zip_executor (with PARALLEL_MEDIA_ZIP),
+    then all the members are written to the zip one after the other, in order.
+    """
+    batch = []
+    sz = 0
+    for cnt, fname in enumerate(fnames):
+        path = os.path.join(media_dir, fname)
+        batch.append((str(cnt), fname, path))
+        sz += os.path.getsize(path)
+        if sz > SYNC_ZIP_SIZE or cnt > SYNC_ZIP_COUNT:
+            break
+
+    stored = {name for name, fname, _ in batch if os.path.splitext(fname)[1].lower() in COMPRESSED_MEDIA_EXTENSIONS}
+    deflated = {}
+    if PARALLEL_MEDIA_ZIP:
+        deflated = {
+            name: media_zip_executor.submit(_deflate_media_file, path) for name, _, path in batch if name not in stored
+        }
+    f = tempfile.SpooledTemporaryFile(max_size=SYNC_ZIP_SIZE)
+    with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        for name, fname, path in batch:
+            if name in deflated:
+                _write_deflated_member(z, zipfile.ZipInfo.from_file(path, name), *deflated[name].result())
+            else:
+                z.write(path, name, compress_type=zipfile.ZIP_STORED if name in stored else zipfile.ZIP_DEFLATED)
+
+        z.writestr("_meta", codec.dumps({name: fname for name, fname, _ in batch}))
+    f.seek(0)
+    return f
+
+
+def _deflate_media_file(path):
+    "The crc, size and raw deflate stream of the file at `path`, as zipfile would compute them"
+    crc = size = 0
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    parts = []
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(DOWNLOAD_BLOCK_SIZE), b""):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            parts.append(compressor.compress(block))
+    parts.append(compressor.flush())
+    return crc, size, b"".join(parts)
+
+
+def _write_deflated_member(z, zinfo, crc, size, data):
+    """
+    Append the member `zinfo` to the zip `z`, its content having been deflated already into `data`. zipfile has no
+    api for that, so this does what ZipFile.writestr does once it has compressed the content, see PARALLEL_MEDIA_ZIP.
+    """
+    # pylint: disable=W0212
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = len(data)
+    with z._lock:
+        zinfo.header_offset = z.fp.tell()
+        z.fp.write(zinfo.FileHeader())
+        z.fp.write(data)
+        z.filelist.append(zinfo)
+        z.NameToInfo[zinfo.filename] = zinfo
+        z.start_dir = z.fp.tell()
+        z._didModify = True
+
+
 def full_download(col, username):
     select_cursor_size = 10000  # this has no effect on memory and less than 1k significantly increases the time
 
@@ -387,10 +528,8 @@ def full_download(col, username):
 
     _check_sqlite3_db(download_db)
 
-    data = open(download_db, "rb").read()
-    os.remove(download_db)
-
-    return data
+    # the caller streams this then closes it, which removes the file
+    return TemporaryDownloadFile(download_db)
 
 
 # using anki's own methods for empty db creation
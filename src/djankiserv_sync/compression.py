@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import re
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+accepts_gzip = re.compile(r"\bgzip\b")
+
+
+class CompressionStats:
+    """
+    Counts the sync responses that got compressed, the bytes before and after compression, and the cpu time spent
+    compressing them (in the threads serving the responses), to tune DJANKISERV_SYNC_GZIP_MIN_SIZE and
+    DJANKISERV_SYNC_GZIP_LEVEL.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.compressed = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    def add(self, bytes_in, bytes_out, cpu_seconds):
+        with self._lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.cpu_seconds += cpu_seconds
+
+    def response(self, compressed):
+        with self._lock:
+            if compressed:
+                self.compressed += 1
+            else:
+                self.skipped += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "compressed": self.compressed,
+                "skipped": self.skipped,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "ratio": round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else None,
+                "cpu_seconds": round(self.cpu_seconds, 3),
+                "min_size": getattr(settings, "DJANKISERV_SYNC_GZIP_MIN_SIZE", 1024),
+                "level": getattr(settings, "DJANKISERV_SYNC_GZIP_LEVEL", 6),
+            }
+
+
+compression_stats = CompressionStats()
+
+
+def _compressor():
+    # wbits 16 + MAX_WBITS writes the gzip header and trailer, so the output can be decoded by any http client
+    return zlib.compressobj(getattr(settings, "DJANKISERV_SYNC_GZIP_LEVEL", 6), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _compress(data):
+    start = time.thread_time()
+    z = _compressor()
+    out = z.compress(data) + z.flush()
+    compression_stats.add(len(data), len(out), time.thread_time() - start)
+    return out
+
+
+def _compress_stream(blocks):
+    z = _compressor()
+    for block in blocks:
+        start = time.thread_time()
+        out = z.compress(block)
+        compression_stats.add(len(block), len(out), time.thread_time() - start)
+        if out:
+            yield out
+    start = time.thread_time()
+    out = z.flush()
+    compression_stats.add(0, len(out), time.thread_time() - start)
+    yield out
+
+
+def compress_response(request, response):
+    """
+    Gzip the `response` if the client accepts it and it is big enough to be worth it. Streamed responses (the
+    collection downloads) are compressed as they are sent, block by block, so they are never held in memory.
+    """
+    if not getattr(settings, "DJANKISERV_SYNC_GZIP", True) or response.status_code != 200:
+        return response
+    patch_vary_headers(response, ("Accept-Encoding",))
+    if response.has_header("Content-Encoding") or not accepts_gzip.search(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+        return response
+
+    min_size = getattr(settings, "DJANKISERV_SYNC_GZIP_MIN_SIZE", 1024)
+    if response.streaming:
+        length = response.get("Content-Length")  # unknown for generators, which are assumed big
+        if length is not None and int(length) < min_size:
+            compression_stats.response(False)
+            return response
+        response.streaming_content = _compress_stream(response.streaming_content)
+        del response["Content-Length"]
+    else:
+        if len(response.content) < min_size:
+            compression_stats.response(False)
+            return response
+        response.content = _compress(response.content)
+        response["Content-Length"] = str(len(response.content))
+
+    response["Content-Encoding"] = "gzip"
+    compression_stats.response(True)
+    return response
+
+
+def gzip_response(view):
+    "Decorator for the sync views that can return big bodies, see `compress_response`"
+
+    @functools.wraps(view)
+    def wrapper(request, *a, **ka):
+        return compress_response(request, view(request, *a, **ka))
+
+    return wrapper
@@ -3,9 +3,9 @@
 import logging
 
 from django.conf import settings
-from django.contrib.sessions.backends.db import SessionStore
 from django.core.exceptions import PermissionDenied
 
+from djankiserv_sync.sessions import SyncSessionStore
 from djankiserv_unki.collection import Collection
 from djankiserv_utils import print_request
 
@@ -17,7 +17,7 @@ logger = logging.getLogger("djankiserv.views")
 
 
 def get_session(request):
-    return SessionStore(session_key=(request.POST.get("k") or request.GET.get("k") or request.POST.get("sk")))
+    return SyncSessionStore(session_key=(request.POST.get("k") or request.GET.get("k") or request.POST.get("sk")))
 
 
 def safe_get_session(request):
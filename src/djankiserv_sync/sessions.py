@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import time
+
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import caches
+
+from djankiserv_unki.cache import LRUCache
+
+# the state of a sync in progress, set by sync/start and sync/chunk and read by the following calls of the sync
+STATE_KEYS = frozenset(("min_usn", "max_usn", "lnewer", "chunk_cursor"))
+EXPIRES = "_djankiserv_expires"
+
+# the host key part of the sessions (skey, name), which never changes once the client has logged in
+session_cache = LRUCache(max_entries=getattr(settings, "DJANKISERV_SYNC_SESSION_CACHE_ENTRIES", 1000))
+
+
+class SyncSessionStore(SessionStore):
+    """
+    Database sessions for the host keys given to the clients, that keep the session table off the hot path of the
+    ~10 requests a sync makes.
+
+    The host key part of a session is immutable, so it is kept in an in-process LRU after the first request, and
+    `safe_get_session` doesn't read the database for the media and meta calls. A host key therefore stays valid
+    until it expires, even if its row gets deleted. The sync state (STATE_KEYS) is only loaded when a view looks
+    it up (with `in`, [] or get), and only written when it has changed. When there is a DJANKISERV_SYNC_SESSION_CACHE
+    (it must be shared by all the server processes), the state is kept there and never written to the database: a
+    sync whose state gets evicted fails, and the client starts it again.
+    """
+
+    cache_key_prefix = "djankiserv.sync_session."
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        alias = getattr(settings, "DJANKISERV_SYNC_SESSION_CACHE", "")
+        self.shared_cache = caches[alias] if alias else None
+        self.state_loaded = False
+        self._stored = {}  # the data as it is in the database (or the shared cache for the state)
+        self._expires = 0
+
+    @property
+    def cache_key(self):
+        return self.cache_key_prefix + self._get_or_create_session_key()
+
+    def __contains__(self, key):
+        self._require(key)
+        return super().__contains__(key)
+
+    def __getitem__(self, key):
+        self._require(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self._require(key)
+        return super().get(key, default)
+
+    def _require(self, key):
+        if key in STATE_KEYS and not self.state_loaded:
+            self._load_state()
+
+    def _get_session_from_db(self):
+        s = super()._get_session_from_db()
+        if s:
+            self._expires = s.expire_date.timestamp()
+        return s
+
+    def _load_state(self):
+        if self.shared_cache is not None:
+            state = self.shared_cache.get(self.cache_key) or {}
+        else:
+            s = self._get_session_from_db()
+            state = {k: v for k, v in self.decode(s.session_data).items() if k in STATE_KEYS} if s else {}
+        self.state_loaded = True
+        for k, v in state.items():
+            self._stored[k] = copy.deepcopy(v)
+            self._session.setdefault(k, v)  # what the view has already set is newer
+
+    def load(self):
+        identity = session_cache.get(self.session_key) if self.session_key else None
+        if identity is not None and identity[EXPIRES] > time.time():
+            self._expires = identity.pop(EXPIRES)
+            self._stored = copy.deepcopy(identity)
+            return identity
+
+        data = super().load()
+        if self.shared_cache is not None:
+            data = {k: v for k, v in data.items() if k not in STATE_KEYS}  # only ever read from the shared cache
+        else:
+            self.state_loaded = True
+        self._stored = copy.deepcopy(data)
+        self._cache_identity(data)
+        return data
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        if not must_create and not self.state_loaded and not STATE_KEYS <= data.keys():
+            self._load_state()  # or saving would drop the state the view hasn't looked at
+
+        identity = {k: v for k, v in data.items() if k not in STATE_KEYS}
+        if self.shared_cache is not None:
+            state = {k: v for k, v in data.items() if k in STATE_KEYS}
+            if state != {k: v for k, v in self._stored.items() if k in STATE_KEYS}:
+                self.shared_cache.set(self.cache_key, state, self.get_expiry_age())
+            changed = identity != {k: v for k, v in self._stored.items() if k not in STATE_KEYS}
+        else:
+            changed = data != self._stored
+        # like a plain database session, an active host key gets its expiry pushed back, only not on every request
+        if must_create or changed or self._expires - time.time() < self.get_expiry_age() / 2:
+            super().save(must_create=must_create)
+            self._expires = self.get_expiry_date().timestamp()
+        self._stored = copy.deepcopy(data)
+        self._cache_identity(identity)
+        return None
+
+    def create_model_instance(self, data):
+        if self.shared_cache is not None:
+            data = {k: v for k, v in data.items() if k not in STATE_KEYS}
+        return super().create_model_instance(data)
+
+    def delete(self, session_key=None):
+        session_key = session_key or self.session_key
+        if session_key:
+            session_cache.invalidate(session_key)
+            if self.shared_cache is not None:
+                self.shared_cache.delete(self.cache_key_prefix + session_key)
+        super().delete(session_key)
+
+    def _cache_identity(self, data):
+        if self.session_key and self._expires:
+            session_cache.put(
+                self.session_key, {**{k: v for k, v in data.items() if k not in STATE_KEYS}, EXPIRES: self._expires}
+            )
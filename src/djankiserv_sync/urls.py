@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
+from django.conf import settings
 from django.urls import path
 
-from djankiserv_sync import views
+if settings.DJANKISERV_ASYNC_VIEWS:
+    from djankiserv_sync.views import asynchronous as views
+else:
+    from djankiserv_sync import views
 
 urlpatterns = [
     # /sync
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from djankiserv_sync import views
+from djankiserv_unki.database import connection_stats
+
+# Under ASGI, django runs sync views one after the other in a single thread, so a slow full upload or media download
+# would hold up every other client of the worker. The views here run the sync ones in a bounded pool of threads
+# instead, which also bounds the number of database connections, and the event loop serves other requests meanwhile.
+#
+# Only the view itself runs in the pool though: django 3.2 iterates the content of a streaming response on the event
+# loop, so the file reads of sync/download (a FileResponse), and their gzip compression (see compress_response), still
+# block it while the body is sent. They are not wrapped with sync_to_async, which 3.2 has no way of consuming.
+executor = ThreadPoolExecutor(max_workers=settings.DJANKISERV_ASYNC_THREADS, thread_name_prefix="djankiserv")
+
+
+def in_thread_pool(view):
+    def run(request, *a, **ka):
+        # django only looks after the connections of its own thread at the start and end of a request
+        close_old_connections()
+        connection_stats.request_started()
+        try:
+            return view(request, *a, **ka)
+        finally:
+            close_old_connections()
+
+    @functools.wraps(view)
+    async def async_view(request, *a, **ka):
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(run, request, *a, **ka))
+
+    return async_view
+
+
+# /sync
+base_meta = in_thread_pool(views.base_meta)
+base_start = in_thread_pool(views.base_start)
+base_applyGraves = in_thread_pool(views.base_applyGraves)
+base_applyChanges = in_thread_pool(views.base_applyChanges)
+base_chunk = in_thread_pool(views.base_chunk)
+base_applyChunk = in_thread_pool(views.base_applyChunk)
+base_sanityCheck2 = in_thread_pool(views.base_sanityCheck2)
+base_finish = in_thread_pool(views.base_finish)
+base_hostKey = in_thread_pool(views.base_hostKey)
+base_upload = in_thread_pool(views.base_upload)
+base_download = in_thread_pool(views.base_download)
+
+# /msync
+media_begin = in_thread_pool(views.media_begin)
+media_mediaChanges = in_thread_pool(views.media_mediaChanges)
+media_mediaSanity = in_thread_pool(views.media_mediaSanity)
+media_uploadChanges = in_thread_pool(views.media_uploadChanges)
+media_downloadFiles = in_thread_pool(views.media_downloadFiles)
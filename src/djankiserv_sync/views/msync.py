@@ -1,17 +1,17 @@
-import io
 import os
-import json
 import time
 import zipfile
 
 from django.conf import settings
-from django.http import JsonResponse, HttpResponse
+from django.http import FileResponse
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.decorators import api_view
 from rest_framework.decorators import permission_classes
 from rest_framework.permissions import AllowAny
 
-from djankiserv_unki import get_data
+from djankiserv_sync import media_zip
+from djankiserv_unki import get_data, get_data_file
+from djankiserv_unki.codec import JsonResponse
 from djankiserv_unki.database import dump_io_to_file
 from djankiserv_sync.dependencies import safe_get_session, get_collection
 
@@ -83,13 +83,11 @@ def media_uploadChanges(request):
     dump_io_to_file(session, "uploadChanges", request, is_media=True)
 
     with get_collection(session) as col:
-        data = get_data(request)["data"]
-
         """
         The zip file contains files the client hasn't synced with the server
         yet ('dirty'), and info on files it has deleted from its own media dir.
         """
-        with zipfile.ZipFile(io.BytesIO(data), "r") as z:
+        with zipfile.ZipFile(get_data_file(request), "r") as z:
             col.check_zip_data(z)
             processed_count = col.adopt_media_changes_from_zip(z)
 
@@ -103,33 +101,13 @@ def media_uploadChanges(request):
 @api_view(["POST"])
 @permission_classes((AllowAny,))
 def media_downloadFiles(request):
-    SYNC_ZIP_SIZE = int(2.5 * 1024 * 1024)
-    SYNC_ZIP_COUNT = 25
-
     session = safe_get_session(request)
     data = get_data(request)
 
     dump_io_to_file(session, "downloadFiles", request, is_media=True)
 
     with get_collection(session) as col:
-        files = data["files"]
-        flist = {}
-        cnt = 0
-        sz = 0
-        f = io.BytesIO()
-
-        with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED) as z:
-            for fname in files:
-                z.write(os.path.join(col.media_dir(), fname), str(cnt))
-                flist[str(cnt)] = fname
-                sz += os.path.getsize(os.path.join(col.media_dir(), fname))
-                if sz > SYNC_ZIP_SIZE or cnt > SYNC_ZIP_COUNT:
-                    break
-                cnt += 1
-
-            z.writestr("_meta", json.dumps(flist))
-
-        resp = HttpResponse(f.getvalue())
+        resp = FileResponse(media_zip(col.media_dir(), data["files"]))
     dump_io_to_file(session, "downloadFiles", resp, is_media=True)
 
     return resp
@@ -3,18 +3,20 @@ import time
 
 from django.conf import settings
 from django.contrib.auth import authenticate
-from django.contrib.sessions.backends.db import SessionStore
 from django.core.exceptions import PermissionDenied
-from django.http import JsonResponse, HttpResponse
+from django.http import FileResponse, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
 
 from djankiserv_unki import get_data
+from djankiserv_unki.codec import JsonResponse
 from djankiserv_unki.database import dump_io_to_file
 from djankiserv_sync import full_upload
-from djankiserv_sync import full_download
+from djankiserv_sync import full_download, DOWNLOAD_BLOCK_SIZE
 from djankiserv_sync import SyncCollectionHandler
+from djankiserv_sync.compression import gzip_response
+from djankiserv_sync.sessions import SyncSessionStore
 from djankiserv_sync.dependencies import safe_get_session, get_collection, print_request
 
 
@@ -47,6 +49,7 @@ def base_meta(request):
 @csrf_exempt
 @api_view(["POST"])
 @permission_classes((AllowAny,))
+@gzip_response
 def base_start(request):
     session = safe_get_session(request)
     data = get_data(request)
@@ -71,6 +74,7 @@ def base_start(request):
         session["min_usn"] = col_handler.min_usn
         session["max_usn"] = col_handler.max_usn
         session["lnewer"] = col_handler.lnewer
+        session["chunk_cursor"] = col_handler.chunk_cursor
         session.save()
 
         resp = JsonResponse(output)
@@ -102,6 +106,7 @@ def base_applyGraves(request):
 @csrf_exempt
 @api_view(["POST"])
 @permission_classes((AllowAny,))
+@gzip_response
 def base_applyChanges(request):
     session = safe_get_session(request)
     data = get_data(request)
@@ -126,24 +131,23 @@ def base_applyChanges(request):
 @csrf_exempt
 @api_view(["POST"])
 @permission_classes((AllowAny,))
+@gzip_response
 def base_chunk(request):
     session = safe_get_session(request)  # performs auth that raises an error if not auth'ed
 
     dump_io_to_file(session, "chunk", request)
 
     with get_collection(session) as col:
-        col_handler = SyncCollectionHandler(col, session=session)
-
-        ## FIXME: this is where  the chunking needs to happen. The original call was to col_handler.chunk()
-        ## which is from a persistent thread which has a database cursor that gets called with chunks of up
-        ## to 250 lines, and it can be called as many times as required until there are none left. This is
-        ## obviously very stupid in our context. The all_data_to_sync_down updates the db to say that everything
-        ## has already been transferred, though in theory the same logic could be used as the cursor but using
-        ## a cache value (we can cache the rows returned but not the cursor)
+        col_handler = SyncCollectionHandler(col, session=session, chunk_size=settings.DJANKISERV_SYNC_CHUNK_SIZE)
 
-        all_new_data = col_handler.all_data_to_sync_down()
+        ## The original call was to col_handler.chunk() from a persistent thread holding a database cursor.
+        ## We can't keep a cursor between requests, so the handler keeps a keyset cursor (table, last id)
+        ## which we persist in the session, and the client keeps calling until it gets `done=True`
+        output = col_handler.chunk()
+        session["chunk_cursor"] = col_handler.chunk_cursor
+        session.save()
 
-        resp = JsonResponse(all_new_data, safe=False)
+        resp = JsonResponse(output, safe=False)
 
     dump_io_to_file(session, "chunk", resp)
 
@@ -219,7 +223,7 @@ def base_hostKey(request):
     if not authenticate(username=username, password=password):
         raise PermissionDenied
 
-    s = SessionStore()
+    s = SyncSessionStore()
     s.create()
     s["skey"] = s.session_key
     s["name"] = username
@@ -237,9 +241,9 @@ def base_upload(request):
 
     dump_io_to_file(session, "upload", request)
 
-    db_bytes = get_data(request)["data"]
+    db_file = get_data(request)["data"]
 
-    resp = HttpResponse(full_upload(db_bytes, session["name"]))
+    resp = HttpResponse(full_upload(db_file, session["name"]))
     dump_io_to_file(session, "upload", resp)
 
     return resp
@@ -248,13 +252,17 @@ def base_upload(request):
 @csrf_exempt
 @api_view(["POST"])
 @permission_classes((AllowAny,))
+@gzip_response
 def base_download(request):
     session = safe_get_session(request)
 
     dump_io_to_file(session, "download", request)
 
     with get_collection(session) as col:
-        resp = HttpResponse(full_download(col, session["name"]))
+        # stream the collection file in blocks rather than loading it into memory, it gets
+        # deleted when the response is closed
+        resp = FileResponse(full_download(col, session["name"]), filename="collection.anki2")
+        resp.block_size = DOWNLOAD_BLOCK_SIZE
     dump_io_to_file(session, "download", resp)
 
     return resp
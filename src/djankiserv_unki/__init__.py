@@ -1,38 +1,73 @@
 # -*- coding: utf-8 -*-
 
 import gzip
-import io
-import json
+import itertools
 import re
+import shutil
+import tempfile
 import time
 from abc import ABC, abstractmethod
 from hashlib import sha1
+from html.entities import name2codepoint
 
+from . import codec
 
-def _decode_data(data, compression=0):
-    if compression:
-        with gzip.GzipFile(mode="rb", fileobj=io.BytesIO(data)) as gz:
-            data = gz.read()
-    try:
-        data = json.loads(data.decode())
-    except (ValueError, UnicodeDecodeError):
-        data = {"data": data}
 
-    return data
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
 
 
-def get_data(request):
-    try:
-        compression = int(request.POST["c"])
-    except KeyError:
-        compression = 0
+def _decode_data(f):
+    "Parse the json payload of the file `f`. Other payloads (full uploads) are returned as `f`, at its start"
+    if f.read(64).lstrip().startswith(b"{"):
+        f.seek(0)
+        try:
+            return codec.loads(f.read())
+        except ValueError:  # also raised for invalid utf-8
+            pass
+    f.seek(0)
+    return {"data": f}
+
 
-    try:
-        data = _decode_data(request.FILES["data"].read(), compression)
-        request.FILES["data"].seek(0)  # need to seek back to zero or it will appear empty after read()!
-    except KeyError:
-        data = {}
-    return data
+def get_data(request):
+    """
+    Return the payload posted by the clients as `data`. It is only decoded once per request, and then cached on
+    it, as both the views and dump_io_to_file ask for it.
+    """
+    request = getattr(request, "_request", request)  # rest_framework's Request wraps the HttpRequest
+    if not hasattr(request, "djankiserv_data"):
+        try:
+            request.djankiserv_data = _decode_data(get_data_file(request))
+        except KeyError:
+            request.djankiserv_data = {}
+    elif hasattr(request.djankiserv_data.get("data"), "seek"):
+        request.djankiserv_data["data"].seek(0)
+    return request.djankiserv_data
+
+
+def get_data_file(request):
+    """
+    Return the posted `data` as a file, without reading it in memory. Django has already spooled big uploads to
+    disk, compressed ones get decompressed incrementally to a temporary file that is also spooled to disk once big,
+    and only once per request.
+    """
+    request = getattr(request, "_request", request)
+    if not hasattr(request, "djankiserv_data_file"):
+        try:
+            compression = int(request.POST["c"])
+        except KeyError:
+            compression = 0
+
+        f = request.FILES["data"]
+        if compression:
+            f.seek(0)
+            with gzip.GzipFile(mode="rb", fileobj=f) as gz:
+                f = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+                shutil.copyfileobj(gz, f, CHUNK_SIZE)
+        request.djankiserv_data_file = f
+
+    request.djankiserv_data_file.seek(0)  # or it will appear empty after a read()!
+    return request.djankiserv_data_file
 
 
 # from anki.utils
@@ -50,6 +85,16 @@ def ids2str(ids):
     return idstring if len(idstring) > 2 else "(0)"
 
 
+def pages(rows, page_size):
+    "Split the iterable `rows` into lists of at most page_size rows"
+    rows = iter(rows)
+    while True:
+        page = list(itertools.islice(rows, page_size))
+        if not page:
+            break
+        yield page
+
+
 def splitFields(string):
     return string.split("\x1f")
 
@@ -64,6 +109,15 @@ def checksum(data):
     return sha1(data).hexdigest()
 
 
+def copy_with_checksum(src, dst):
+    "Copy the file `src` to `dst` in chunks, returning the same checksum as `checksum` would for its content"
+    csum = sha1()
+    for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+        csum.update(chunk)
+        dst.write(chunk)
+    return csum.hexdigest()
+
+
 # deck schema & syncing vars
 REM_CARD = 0
 REM_NOTE = 1
@@ -98,8 +152,7 @@ def entsToTxt(html):
         else:
             # named entity
             try:
-                # FIXME: name2codepoint doesn't exist anywhere!!!
-                text = chr(name2codepoint[text[1:-1]])  # noqa: F821  # pylint: disable=E0602
+                text = chr(name2codepoint[text[1:-1]])
             except KeyError:
                 pass
         return text  # leave as is
@@ -108,17 +161,21 @@ def entsToTxt(html):
 
 
 def stripHTML(s):
-    s = reComment.sub("", s)
-    s = reStyle.sub("", s)
-    s = reScript.sub("", s)
-    s = reTag.sub("", s)
-    s = entsToTxt(s)
+    # most fields are plain text, so skip the passes that can't match anything
+    if "<" in s:
+        s = reComment.sub("", s)
+        s = reStyle.sub("", s)
+        s = reScript.sub("", s)
+        s = reTag.sub("", s)
+    if "&" in s:
+        s = entsToTxt(s)
     return s
 
 
 def stripHTMLMedia(s):
     "Strip HTML but keep media filenames"
-    s = reMedia.sub(" \\1 ", s)
+    if "<" in s:
+        s = reMedia.sub(" \\1 ", s)
     return stripHTML(s)
 
 
@@ -257,10 +314,16 @@ class AnkiDataModelBase(ABC):
             "parent": MEDIA_PARENT_DB,
         },
         "meta": {
-            "fields": [{"name": "dirmod", "type": "bigint"}, {"name": "lastusn", "type": "bigint"}],
+            # lastusn and mediacount are maintained with every change to the media table. A NULL mediacount means
+            # they have to be recomputed, see Collection.repair_media_meta
+            "fields": [
+                {"name": "dirmod", "type": "bigint"},
+                {"name": "lastusn", "type": "bigint"},
+                {"name": "mediacount", "type": "bigint", "nullable": True},
+            ],
             "indexes": [],
             "parent": MEDIA_PARENT_DB,
-            "initsql": "insert into {schema_name}.meta values (0, 0);",
+            "initsql": "insert into {schema_name}.meta values (0, 0, 0);",
         },
     }
 
@@ -279,7 +342,44 @@ class AnkiDataModelBase(ABC):
     def insert_on_conflict_nothing(schema_name, table_name):
         pass
 
+    @staticmethod
+    @abstractmethod
+    def upsert(cur, schema_name, table_name, rows, update=True, page_size=1000):
+        """
+        Insert every row of the iterable `rows` (in MODEL field order), updating the existing row with the same
+        primary key, or leaving it as it is if not `update`. Rows are sent as multi-row statements of `page_size` rows.
+        """
+
+    @staticmethod
+    @abstractmethod
+    def merge(cur, schema_name, table_name, rows, min_usn, page_size=1000):
+        """
+        Upsert the `rows` sent by a client, except where the existing row has changed since the client last synced
+        (usn >= min_usn) and is at least as recent as the client's. Returns the ids of the rows written.
+        """
+
+    @staticmethod
+    @abstractmethod
+    def bulk_update(cur, schema_name, table_name, columns, rows, page_size=1000):
+        """
+        Set the `columns` of the rows whose primary key is the first value of each of `rows`, to the values that
+        follow it, with multi-row statements of `page_size` rows.
+        """
+
     @staticmethod
     @abstractmethod
     def replace_schema(cur, to_replace_name, replace_with_name):
         pass
+
+    @staticmethod
+    def bulk_insert(cur, schema_name, table_name, rows, page_size=10000):
+        """
+        Insert every row of the iterable `rows` (in MODEL field order) into an empty table, used for full uploads.
+        This default pages the rows through `executemany`, backends override it with something faster.
+        """
+        fields = AnkiDataModelBase.MODEL[table_name]["fields"]
+        fstr = ", ".join(["%s"] * len(fields))
+        sql = f"INSERT INTO {schema_name}.{table_name} ({','.join(f['name'] for f in fields)}) VALUES ({fstr})"
+
+        for page in pages(rows, page_size):
+            cur.executemany(sql, page)
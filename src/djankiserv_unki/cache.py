@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class LRUCache:
+    """
+    In-process LRU cache of picklable values, bounded by a number of entries and by the size of their pickles.
+
+    Values are kept pickled, so each `get` hands out fresh objects that the caller may mutate. A value may be put
+    with a `tag` (e.g. a version), and is then only returned to a `get` with an equal tag.
+    """
+
+    def __init__(self, max_entries=100, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # name -> (tag, pickled value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name, tag=None):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry[0] != tag:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+            data = entry[1]
+        return pickle.loads(data)
+
+    def put(self, name, value, tag=None):
+        if not self.max_entries:
+            return
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._remove(name)
+            if len(data) > self.max_bytes:
+                return
+            self._entries[name] = (tag, data)
+            self._bytes += len(data)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, name):
+        with self._lock:
+            self._remove(name)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, name):
+        entry = self._entries.pop(name, None)
+        if entry:
+            self._bytes -= len(entry[1])
+
+
+class CollectionCache(LRUCache):
+    """
+    LRU cache of the parsed `col` row of each user's collection (conf, models, decks, dconf, tags...).
+
+    Entries are validated against a key made of cheap `col` columns (modified, usn) so a change made by another
+    process is never served stale: every write to the collection blobs goes through `Collection.save()`, which
+    bumps `modified`.
+    """
+
+    def get(self, username, key):  # pylint: disable=W0221
+        return super().get(username, tag=key)
+
+    def put(self, username, key, state):  # pylint: disable=W0221
+        super().put(username, state, tag=key)
+
+
+collection_cache = CollectionCache(
+    max_entries=getattr(settings, "DJANKISERV_COLLECTION_CACHE_ENTRIES", 100),
+    max_bytes=getattr(settings, "DJANKISERV_COLLECTION_CACHE_BYTES", 64 * 1024 * 1024),
+)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import json
+import math
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+try:
+    import orjson
+except ImportError:  # the optional `json` extra isn't installed
+    orjson = None
+
+
+class StdlibCodec:
+    "The json of the standard library, which can encode everything DjangoJSONEncoder can"
+
+    name = "json"
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj, cls=DjangoJSONEncoder)
+
+    def dumps_bytes(self, obj):
+        return self.dumps(obj).encode()
+
+
+class OrjsonCodec:
+    """
+    orjson, several times faster than the standard library for both parsing and serialising. It writes compact,
+    utf-8 json, and leaves what it can't handle (ints of more than 64 bits, NaN and the infinities, which orjson
+    would silently write as null) to StdlibCodec. datetimes, Decimals, UUIDs... are handed to DjangoJSONEncoder,
+    so they come out as they do with StdlibCodec (e.g. datetimes in milliseconds, UTC as Z).
+    """
+
+    name = "orjson"
+
+    def __init__(self):
+        self.fallback = StdlibCodec()
+        self.default = DjangoJSONEncoder().default
+
+    def loads(self, data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return self.fallback.loads(data)
+
+    def dumps(self, obj):
+        return self.dumps_bytes(obj).decode()
+
+    def dumps_bytes(self, obj):
+        try:
+            data = orjson.dumps(
+                obj, default=self.default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+            )
+        except orjson.JSONEncodeError:
+            return self.fallback.dumps_bytes(obj)
+        # a non-finite float has become a null, which only needs looking for when there is one
+        if b"null" in data and _has_non_finite(obj):
+            return self.fallback.dumps_bytes(obj)
+        return data
+
+
+def _has_non_finite(obj):
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(v) for v in obj)
+    return False
+
+
+def get_codec(name="auto"):
+    "The codec called `name`, `auto` being orjson when it is installed"
+    if name == "auto":
+        name = "orjson" if orjson else "json"
+    if name == "orjson":
+        if not orjson:
+            raise ImportError("The orjson json codec needs the orjson package, install djankiserv[json]")
+        return OrjsonCodec()
+    if name == "json":
+        return StdlibCodec()
+    raise ValueError(f"Unknown json codec '{name}'")
+
+
+codec = get_codec(getattr(settings, "DJANKISERV_JSON_CODEC", "auto"))
+
+
+def loads(data):
+    "Parse the json `data`, a str or bytes"
+    return codec.loads(data)
+
+
+def dumps(obj):
+    "Serialise `obj` to a json str, e.g. for the json columns of the `col` table"
+    return codec.dumps(obj)
+
+
+class JsonResponse(HttpResponse):
+    "django.http.JsonResponse, serialised by the configured codec"
+
+    def __init__(self, data, safe=True, **kwargs):
+        if safe and not isinstance(data, dict):
+            raise TypeError("In order to allow non-dict objects to be serialized set the safe parameter to False.")
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(content=codec.dumps_bytes(data), **kwargs)
@@ -1,20 +1,24 @@
 # -*- coding: utf-8 -*-
 
+import csv
+import io
+import itertools
 import json
 import logging
 import os
 import pathlib
 import pickle
 import subprocess
+import threading
 
 from django.conf import settings
-from django.db import connection, connections
-from django.http import HttpResponse
+from django.db import connection, connections, transaction
+from django.http import HttpResponse, StreamingHttpResponse
 
 import djankiserv_unki
 from djankiserv.assets import jsonfiles  # noqa: 401  # pylint: disable=W0611
 
-from . import AnkiDataModelBase, get_data
+from . import AnkiDataModelBase, get_data, pages
 
 MODEL_STD = 0
 NEW_CARDS_DUE = 1
@@ -29,16 +33,85 @@ def db_conn():
     return connection
 
 
+class ConnectionStats:
+    """
+    Counts how the `userdata` connections get opened and reused across requests, with the CONN_MAX_AGE of the
+    alias. The counters are updated from the connection_created and request_started signals.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+        self.unusable = 0
+
+    def connection_created(self):
+        with self._lock:
+            self.opened += 1
+
+    def request_started(self):
+        """
+        Django has already closed a connection past its CONN_MAX_AGE by the time this gets called, so one that is
+        still open is going to be reused. Like CONN_HEALTH_CHECKS from django 4.1, check that it still works first.
+        """
+        conn = db_conn()
+        if conn.connection is None:
+            return
+        with self._lock:
+            self.reused += 1
+        if getattr(settings, "DJANKISERV_USERDB_CONN_HEALTH_CHECKS", True) and not conn.is_usable():
+            conn.close()
+            with self._lock:
+                self.unusable += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "conn_max_age": db_conn().settings_dict.get("CONN_MAX_AGE", 0),
+                "opened": self.opened,
+                "reused": self.reused,
+                "unusable": self.unusable,
+            }
+
+
+connection_stats = ConnectionStats()
+
+
 class StandardDB:
+    # Schemas known to exist, so we don't hit the catalog for every collection we open. It is warmed with
+    # a single query on first use, and only holds positives, so schemas created by another process are
+    # still found via the catalog. Deleting a user goes through `delete_schema`, which removes it.
+    _known_schemas = None
+    _known_schemas_lock = threading.Lock()
+    _upgraded_schemas = set()
+
     def __init__(self):  # pylint: disable=W0231
         self._db = db_conn()
         self.mod = False
 
+    @staticmethod
+    def known_schemas():
+        with StandardDB._known_schemas_lock:
+            if StandardDB._known_schemas is None:
+                with db_conn().cursor() as cur:
+                    cur.execute("SELECT SCHEMA_NAME FROM INFORMATION_SCHEMA.SCHEMATA")
+                    StandardDB._known_schemas = {row[0] for row in cur.fetchall()}
+            return StandardDB._known_schemas
+
+    @staticmethod
+    def forget_schema(schema_name):
+        StandardDB.known_schemas().discard(schema_name)
+        StandardDB._upgraded_schemas.discard(schema_name)
+
     @staticmethod
     def schema_exists(schema_name):
+        if schema_name in StandardDB.known_schemas():
+            return 1
         with db_conn().cursor() as cur:
             cur.execute("SELECT 1 FROM INFORMATION_SCHEMA.SCHEMATA WHERE SCHEMA_NAME = %s", (schema_name,))
             res = cur.fetchone()
+        if res:
+            StandardDB.known_schemas().add(schema_name)
         return res[0] if res else 0
 
     @staticmethod
@@ -50,13 +123,46 @@ class StandardDB:
                     continue
                 cur.execute(sql)
             res = cur.fetchone()
-            return res[0]  # returns an Ok message
+        StandardDB.known_schemas().add(schema_name)
+        StandardDB._upgraded_schemas.add(schema_name)
+        return res[0]  # returns an Ok message
         # db_conn().commit()
 
+    @staticmethod
+    def existing_columns(schema_name):
+        "The (table, column) of the tables of `schema_name`"
+        with db_conn().cursor() as cur:
+            cur.execute(
+                "SELECT TABLE_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = %s", (schema_name,)
+            )
+            return {(table_name.lower(), column_name.lower()) for table_name, column_name in cur.fetchall()}
+
+    @staticmethod
+    def upgrade_schema(schema_name):
+        """
+        Add the columns that have been added to the MODEL since the schema was created, checking only once per
+        process. Several processes may upgrade the same schema at once, so adding a column that exists is fine.
+        """
+        if schema_name in StandardDB._upgraded_schemas:
+            return
+        existing = StandardDB.existing_columns(schema_name)
+        with db_conn().cursor() as cur:
+            for table_name, defin in djankiserv_unki.AnkiDataModel.MODEL.items():
+                for f in defin["fields"]:
+                    if (table_name, f["name"]) not in existing:
+                        assert f.get("nullable")  # existing rows get NULL
+                        # another process may be adding it at the same time
+                        cur.execute(
+                            f"ALTER TABLE {schema_name}.{table_name} "
+                            f"ADD COLUMN IF NOT EXISTS {f['name']} {f['type']} NULL"
+                        )
+        StandardDB._upgraded_schemas.add(schema_name)
+
     @staticmethod
     def delete_schema(schema_name):
         with db_conn().cursor() as cur:
             cur.execute(djankiserv_unki.AnkiDataModel.DROP_SCHEMA.replace("{schema_name}", schema_name))
+        StandardDB.forget_schema(schema_name)
 
     def execute(self, sql, *a, **ka):
         s = sql.strip().lower()
@@ -77,10 +183,47 @@ class StandardDB:
         cur.executemany(sql, list(li))  # list() due to https://github.com/korfuri/django-prometheus/issues/240
         return cur
 
+    def upsert(self, schema_name, table_name, rows, update=True):
+        self.mod = True
+        djankiserv_unki.AnkiDataModel.upsert(
+            self._db.cursor(),
+            schema_name,
+            table_name,
+            rows,
+            update=update,
+            page_size=getattr(settings, "DJANKISERV_UPSERT_PAGE_SIZE", 1000),
+        )
+
+    def merge(self, schema_name, table_name, rows, min_usn):
+        self.mod = True
+        return djankiserv_unki.AnkiDataModel.merge(
+            self._db.cursor(),
+            schema_name,
+            table_name,
+            rows,
+            min_usn,
+            page_size=getattr(settings, "DJANKISERV_UPSERT_PAGE_SIZE", 1000),
+        )
+
+    def bulk_update(self, schema_name, table_name, columns, rows):
+        self.mod = True
+        djankiserv_unki.AnkiDataModel.bulk_update(
+            self._db.cursor(),
+            schema_name,
+            table_name,
+            columns,
+            rows,
+            page_size=getattr(settings, "DJANKISERV_UPSERT_PAGE_SIZE", 1000),
+        )
+
     def commit(self):
         pass
         # self._db.commit()
 
+    def atomic(self):
+        "Run the statements of the `with` block in a single transaction, the connection is in autocommit otherwise"
+        return transaction.atomic(using=self._db.alias)
+
     def scalar(self, *a):
         res = self.execute(*a).fetchone()  # pylint: disable=E1120  # FIXME: how should I get rid of this disable?
         if res:
@@ -111,7 +254,12 @@ def dump_io_to_file(session, method, io_obj, is_media=False):  # noqa: C901  # p
     fname_dir = session["dump_base"] if not is_media else session["dump_base_media"]
     pathlib.Path(fname_dir).mkdir(parents=True, exist_ok=True)
 
-    if isinstance(io_obj, HttpResponse):
+    if isinstance(io_obj, StreamingHttpResponse):
+        # we mustn't consume the stream, it is still to be sent to the client
+        fname_base = os.path.join(fname_dir, "post_" + method)
+        to_print = "Response Content:\n<streamed>\n"
+        io_obj_json = {"to_return": "<streamed>"}
+    elif isinstance(io_obj, HttpResponse):
         fname_base = os.path.join(fname_dir, "post_" + method)
         to_print = f"Response Content:\n{io_obj.content}\n"
         try:
@@ -121,8 +269,10 @@ def dump_io_to_file(session, method, io_obj, is_media=False):  # noqa: C901  # p
     else:
         fname_base = os.path.join(fname_dir, "pre_" + method)
         to_print = f"POST:\n{io_obj.POST}\n\n"
-        to_print += f"DATA:\n{get_data(io_obj)}\n"
         io_obj_json = get_data(io_obj)
+        if hasattr(io_obj_json.get("data"), "read"):  # full uploads, dumped as bytes
+            io_obj_json = {"data": io_obj_json["data"].read()}
+        to_print += f"DATA:\n{io_obj_json}\n"
 
     if os.path.exists(fname_base + ".txt"):
         i = 1
@@ -174,6 +324,46 @@ def dump_io_to_file(session, method, io_obj, is_media=False):  # noqa: C901  # p
         )
 
 
+class CsvCopyStream:
+    """
+    Read-only file-like object that renders rows lazily as CSV, for feeding `COPY ... FROM STDIN`
+    without materialising the whole table in memory.
+    """
+
+    def __init__(self, rows, int_cols=()):
+        self._rows = iter(rows)
+        self._int_cols = int_cols
+        self._buf = io.StringIO()
+        self._writer = csv.writer(self._buf, lineterminator="\n")
+        self._pending = ""
+        self._pos = 0
+
+    def _row(self, row):
+        # sqlite happily stores floats in integer columns, which COPY won't accept for a bigint
+        if self._int_cols and any(isinstance(row[i], float) for i in self._int_cols):
+            row = list(row)
+            for i in self._int_cols:
+                if isinstance(row[i], float):
+                    row[i] = round(row[i])
+        return row
+
+    def read(self, size=-1):
+        while size < 0 or len(self._pending) - self._pos < size:
+            rows = list(itertools.islice(self._rows, 1000))
+            if not rows:
+                break
+            self._writer.writerows(self._row(r) for r in rows)
+            self._pending = self._pending[self._pos :] + self._buf.getvalue()
+            self._pos = 0
+            self._buf.seek(0)
+            self._buf.truncate()
+
+        end = len(self._pending) if size < 0 else min(self._pos + size, len(self._pending))
+        data = self._pending[self._pos : end]
+        self._pos = end
+        return data
+
+
 class PostgresAnkiDataModel(AnkiDataModelBase):
     MODEL_SETUP = ""
 
@@ -265,6 +455,61 @@ class PostgresAnkiDataModel(AnkiDataModelBase):
             + f"ON CONFLICT ({identity[0]}) DO NOTHING "
         )
 
+    @staticmethod
+    def upsert(cur, schema_name, table_name, rows, update=True, page_size=1000):
+        from psycopg2.extras import execute_values  # pylint: disable=C0415  # psycopg2 is an optional dependency
+
+        if update:
+            sql = PostgresAnkiDataModel.insert_on_conflict_update(schema_name, table_name)
+            # a statement can't update the same row twice, so only keep the last version of each row like
+            # executing them one by one would
+            pk = [i for i, f in enumerate(AnkiDataModelBase.MODEL[table_name]["fields"]) if "is_pk" in f][0]
+            rows = {row[pk]: row for row in rows}.values()
+        else:
+            sql = PostgresAnkiDataModel.insert_on_conflict_nothing(schema_name, table_name)
+        # execute_values pages the rows itself, replacing the VALUES placeholder with up to page_size rows
+        fstr = ", ".join(["%s"] * len(AnkiDataModelBase.MODEL[table_name]["fields"]))
+        execute_values(cur, sql.replace(f"VALUES ({fstr})", "VALUES %s", 1), rows, page_size=page_size)
+
+    @staticmethod
+    def merge(cur, schema_name, table_name, rows, min_usn, page_size=1000):
+        from psycopg2.extras import execute_values  # pylint: disable=C0415  # psycopg2 is an optional dependency
+
+        # the newer-than check is part of the upsert, so there is no need to get the existing rows first
+        fields = AnkiDataModelBase.MODEL[table_name]["fields"]
+        sql = PostgresAnkiDataModel.insert_on_conflict_update(schema_name, table_name).replace(
+            f"VALUES ({', '.join(['%s'] * len(fields))})", "VALUES %s", 1
+        )
+        sql += f" WHERE {table_name}.usn < {int(min_usn)} OR {table_name}.modified < EXCLUDED.modified RETURNING id"
+        rows = {row[0]: row for row in rows}.values()  # see `upsert`
+        return [row[0] for row in execute_values(cur, sql, rows, page_size=page_size, fetch=True)]
+
+    @staticmethod
+    def bulk_update(cur, schema_name, table_name, columns, rows, page_size=1000):
+        from psycopg2.extras import execute_values  # pylint: disable=C0415  # psycopg2 is an optional dependency
+
+        pk = [x["name"] for x in AnkiDataModelBase.MODEL[table_name]["fields"] if "is_pk" in x][0]
+        execute_values(
+            cur,
+            f"UPDATE {schema_name}.{table_name} t SET {', '.join(f'{c} = v.{c}' for c in columns)} "
+            f"FROM (VALUES %s) AS v ({pk}, {', '.join(columns)}) WHERE t.{pk} = v.{pk}",
+            rows,
+            page_size=page_size,
+        )
+
+    @staticmethod
+    def bulk_insert(cur, schema_name, table_name, rows, page_size=10000):
+        # a single COPY streamed from the source cursor, page_size is irrelevant here
+        fields = AnkiDataModelBase.MODEL[table_name]["fields"]
+        int_cols = [i for i, f in enumerate(fields) if f["type"] == "bigint"]
+        # csv writes '' unquoted, which COPY would otherwise read as NULL
+        not_null = ",".join(f["name"] for f in fields if f["type"] == "text" and not f.get("nullable"))
+        options = "FORMAT csv" + (f", FORCE_NOT_NULL ({not_null})" if not_null else "")
+        cur.copy_expert(
+            f"COPY {schema_name}.{table_name} ({','.join(f['name'] for f in fields)}) FROM STDIN WITH ({options})",
+            CsvCopyStream(rows, int_cols),
+        )
+
     @staticmethod
     def replace_schema(cur, to_replace_name, replace_with_name):
         # rename the existing schema, rename the new schema to the username, delete the old schema
@@ -274,6 +519,8 @@ class PostgresAnkiDataModel(AnkiDataModelBase):
 
 
 class MariadbAnkiDataModel(AnkiDataModelBase):
+    # bulk_insert uses the default `executemany`, which mysqlclient already rewrites into multi-row
+    # INSERT ... VALUES statements. LOAD DATA LOCAL INFILE would need local_infile on client and server
 
     MODEL_SETUP = ""
     MODEL_SETUP_LIST = []
@@ -362,6 +609,48 @@ class MariadbAnkiDataModel(AnkiDataModelBase):
             + f"ON DUPLICATE KEY UPDATE {identity[0]} = {identity[0]}"
         )
 
+    @staticmethod
+    def upsert(cur, schema_name, table_name, rows, update=True, page_size=1000):
+        # mysqlclient rewrites the executemany of an INSERT ... VALUES ... ON DUPLICATE KEY UPDATE into multi-row
+        # statements, so it only needs paging
+        if update:
+            sql = MariadbAnkiDataModel.insert_on_conflict_update(schema_name, table_name)
+        else:
+            sql = MariadbAnkiDataModel.insert_on_conflict_nothing(schema_name, table_name)
+        for page in pages(rows, page_size):
+            cur.executemany(sql, page)
+
+    @staticmethod
+    def bulk_update(cur, schema_name, table_name, columns, rows, page_size=1000):
+        # mariadb can't name the columns of a VALUES list, so join on a union of selects instead
+        pk = [x["name"] for x in MariadbAnkiDataModel.MODEL[table_name]["fields"] if "is_pk" in x][0]
+        select = f"SELECT %s AS {pk}, {', '.join(f'%s AS {c}' for c in columns)}"
+        for page in pages(rows, page_size):
+            cur.execute(
+                f"UPDATE {schema_name}.{table_name} t JOIN ({' UNION ALL '.join([select] * len(page))}) v "
+                f"ON t.{pk} = v.{pk} SET {', '.join(f't.{c} = v.{c}' for c in columns)}",
+                list(itertools.chain.from_iterable(page)),
+            )
+
+    @staticmethod
+    def merge(cur, schema_name, table_name, rows, min_usn, page_size=1000):
+        # the check can't go in the ON DUPLICATE KEY UPDATE, as mariadb assigns the columns one after the other, so
+        # get the existing modification times a page at a time instead
+        mod_idx = [f["name"] for f in AnkiDataModelBase.MODEL[table_name]["fields"]].index("modified")
+        written = []
+        for page in pages(rows, page_size):
+            cur.execute(
+                f"""select id, modified from {schema_name}.{table_name}
+                    where id in ({', '.join(['%s'] * len(page))}) and usn >= %s""",
+                [row[0] for row in page] + [min_usn],
+            )
+            lmods = dict(cur.fetchall())
+            newer = [row for row in page if row[0] not in lmods or lmods[row[0]] < row[mod_idx]]
+            if newer:
+                cur.executemany(MariadbAnkiDataModel.insert_on_conflict_update(schema_name, table_name), newer)
+                written += [row[0] for row in newer]
+        return written
+
     @staticmethod
     def replace_schema(cur, to_replace_name, replace_with_name):
         # rename the existing schema, rename the new schema to the username, delete the old schema
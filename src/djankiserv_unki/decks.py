@@ -3,11 +3,11 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 import copy
-import json
 import operator
 import pkgutil
 import unicodedata
 
+from djankiserv_unki import codec
 from djankiserv_unki import ids2str, intTime  # intTime is never actually used, so all occurrences are dead code
 
 REM_DECK = 2
@@ -21,8 +21,8 @@ class DeckManager:  # pylint: disable=R0904
         self.changed = False  # to make pylint happy
 
     def load(self, decks, dconf):
-        self.decks = json.loads(decks)
-        self.dconf = json.loads(dconf)
+        self.decks = decks
+        self.dconf = dconf
         # set limits to within bounds
         found = False
         for c in list(self.dconf.values()):
@@ -45,7 +45,9 @@ class DeckManager:  # pylint: disable=R0904
     def flush(self):
         if self.changed:
             self.col.db.execute(
-                f"update {self.col.username}.col set decks=%s, dconf=%s", json.dumps(self.decks), json.dumps(self.dconf)
+                f"update {self.col.username}.col set decks=%s, dconf=%s",
+                codec.dumps(self.decks),
+                codec.dumps(self.dconf),
             )
             self.changed = False
 
@@ -249,7 +251,7 @@ class DeckManager:  # pylint: disable=R0904
     def get_or_add(self, name, create=True, dtype=None):
         "Add a deck with NAME. Reuse deck if already exists. Return id as int."
         if dtype is None:
-            dtype = json.loads(pkgutil.get_data("djankiserv.assets.jsonfiles", "default_deck.json").decode("utf-8"))
+            dtype = codec.loads(pkgutil.get_data("djankiserv.assets.jsonfiles", "default_deck.json").decode("utf-8"))
 
         name = name.replace('"', "")
         name = unicodedata.normalize("NFC", name)
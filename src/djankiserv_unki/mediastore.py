@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import uuid
+from hashlib import sha1
+
+from . import CHUNK_SIZE
+
+logger = logging.getLogger("djankiserv_unki.mediastore")
+
+
+class MediaStore:
+    """
+    Content-addressed store of the media files of all users, keyed by the sha1 `csum` of the media tables.
+
+    Each blob is a file in `root` (under DJANKISERV_DATA_ROOT, so on the same filesystem as the users' media
+    directories), and each user's media file with that content is a hard link to it. The users' media directories
+    therefore stay plain directories of files that can be read as before, while the content is only stored (and
+    cached by the OS) once. The link count of the inode is the reference count: a blob with a single link is only
+    referenced by the store and is removed. Media files are only ever replaced, never written to in place, so a
+    user can't change the content of a blob shared with other users.
+    """
+
+    DIRNAME = ".store"
+
+    def __init__(self, root):
+        self.root = root
+
+    def blob_path(self, csum):
+        return os.path.join(self.root, csum[:2], csum)
+
+    def store(self, path, csum):
+        """
+        Deduplicate the media file `path`, whose content has the checksum `csum`: it becomes a link to the blob with
+        that content, or becomes that blob if there is none yet.
+        """
+        blob = self.blob_path(csum)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(path, blob)
+            return
+        except FileExistsError:
+            pass
+        except OSError as err:  # no hard link support, the file just doesn't get deduplicated
+            logger.warning("Can't add '%s' to the media store: %s", path, str(err))
+            return
+
+        temp_path = os.path.join(os.path.dirname(path), f".link-{uuid.uuid4().hex}")
+        try:
+            os.link(blob, temp_path)
+        except FileNotFoundError:  # the blob has just been released by its last user, keep our copy
+            return
+        os.replace(temp_path, path)
+
+    def release(self, path, csum):
+        "Remove the media file `path`, and the blob with its content `csum` if no other media file links to it"
+        if os.path.exists(path):
+            os.remove(path)
+        if csum:
+            self.collect(self.blob_path(csum))
+
+    def release_dir(self, media_dir, csums):
+        """
+        Remove all the files of the media directory `media_dir`, and the blobs no other media file links to. The
+        checksums come from `csums` (name -> csum), those of the files it doesn't have (a full upload empties the
+        media table, but not the media directory) are computed if the file is linked to anything.
+        """
+        for entry in os.scandir(media_dir):
+            if not entry.is_file():
+                continue
+            csum = csums.get(entry.name)
+            if csum is None and entry.stat().st_nlink > 1:
+                csum = self.checksum(entry.path)
+            self.release(entry.path, csum)
+
+    @staticmethod
+    def checksum(path):
+        "The sha1 of the content of the file `path`, as in the `csum` of the media tables"
+        csum = sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):  # pylint: disable=W0640
+                csum.update(chunk)
+        return csum.hexdigest()
+
+    @staticmethod
+    def collect(blob):
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+                return True
+        except FileNotFoundError:
+            pass
+        return False
+
+    def migrate(self, media_dir):
+        """
+        Deduplicate all the files of an existing media directory, returning the number of files and the number of bytes
+        that are now shared with a blob that was already in the store. The files are checksummed then linked, so this
+        mustn't run while the user uploads media.
+        """
+        files = saved = 0
+        for entry in os.scandir(media_dir):
+            if not entry.is_file() or entry.name.startswith("."):  # skips the temporary files of uploads
+                continue
+            csum = self.checksum(entry.path)
+            if os.path.exists(self.blob_path(csum)) and not os.path.samefile(entry.path, self.blob_path(csum)):
+                files += 1
+                saved += entry.stat().st_size
+            self.store(entry.path, csum)
+        return files, saved
+
+    def collect_all(self):
+        "Remove the blobs that are no longer linked to by any media file, returning how many were removed"
+        removed = 0
+        if not os.path.isdir(self.root):
+            return removed
+        for shard in os.scandir(self.root):
+            if shard.is_dir():
+                removed += sum(self.collect(blob.path) for blob in os.scandir(shard.path))
+        return removed
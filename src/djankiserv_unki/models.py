@@ -2,10 +2,10 @@
 # Copyright: Ankitects Pty Ltd and contributors
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import json
 import re
 import time
 
+from djankiserv_unki import codec
 from djankiserv_unki import checksum  # checksum never actually used, so all occurrences dead code
 from djankiserv_unki import splitFields
 
@@ -18,15 +18,15 @@ class ModelManager:
         self.needs_saving = False  # to make pylint happy
         self.models = None  # to make pylint happy
 
-    def load(self, json_):
-        "Load registry from JSON."
+    def load(self, models):
+        "Load registry from the parsed JSON."
         self.needs_saving = False
-        self.models = json.loads(json_)
+        self.models = models
 
     def flush(self):
         "Flush the registry if any models were changed."
         if self.needs_saving:
-            self.col.db.execute(f"update {self.col.username}.col set models = %s", json.dumps(self.models))
+            self.col.db.execute(f"update {self.col.username}.col set models = %s", codec.dumps(self.models))
             self.needs_saving = False
 
     def get(self, mid):
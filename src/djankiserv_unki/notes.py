@@ -2,13 +2,12 @@
 # Copyright: Ankitects Pty Ltd and contributors
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import json
 import random
 import string
 
 import djankiserv_unki
 
-from . import fieldChecksum, intTime, joinFields, splitFields, stripHTMLMedia
+from . import codec, fieldChecksum, intTime, joinFields, splitFields, stripHTMLMedia
 
 
 def guid64():
@@ -76,7 +75,7 @@ class Note:  # pylint: disable=R0902
         return {"id": self.id, "model": self._model["name"], "fields": self.fields, "tags": self.tags}
 
     def __str__(self):
-        return json.dumps(self.as_dict())
+        return codec.dumps(self.as_dict())
 
     def flush(self, mod=None):
         "If fields or tags have changed, write changes to disk."
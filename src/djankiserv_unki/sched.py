@@ -32,10 +32,12 @@ class Scheduler:
         self.reps = 0
         self.today = None
         self._haveQueues = False
+        self._deckCounts = {}
         self._updateCutoff()
 
     def reset(self):
         self._updateCutoff()
+        self._loadDeckCounts()
         self._resetLrn()
         self._resetRev()
         self._resetNew()
@@ -87,10 +89,50 @@ class Scheduler:
             tot += cnt
         return tot
 
+    def _loadDeckCounts(self):
+        """
+        Count the new, learning and review cards of every deck with a single query grouped by deck and
+        queue, bucketed by the due cutoffs. The per-deck and parent limits are then applied in python,
+        so the number of queries doesn't depend on the number of decks. Like the client, the learning
+        steps left are only summed over the first `reportLimit` cards of each deck, which takes a
+        second query.
+        """
+        self._deckCounts = {}
+        for did, queue, cnt, due in self.col.db.execute(
+            f"""
+            select did, queue, count(0), sum(case when due <= %s then 1 else 0 end)
+            from {self.col.username}.cards where queue in (0, 2, 3) group by did, queue""",
+            self.today,
+        ):
+            counts = self._deckCounts.setdefault(int(did), dict(new=0, lrnNow=0, dayLrn=0, rev=0))
+            if queue == 0:
+                counts["new"] = int(cnt)
+            elif queue == 2:
+                counts["rev"] = int(due or 0)
+            else:
+                counts["dayLrn"] = int(due or 0)
+
+        for did, lrnNow in self.col.db.execute(
+            f"""
+            select did, sum(remaining/1000) from (
+                select did, remaining, row_number() over (partition by did order by id) as n
+                from {self.col.username}.cards where queue = 1 and due < %s) as foo
+            where n <= %s group by did""",
+            intTime() + self.col.conf["collapseTime"],
+            self.reportLimit,
+        ):
+            counts = self._deckCounts.setdefault(int(did), dict(new=0, lrnNow=0, dayLrn=0, rev=0))
+            counts["lrnNow"] = int(lrnNow or 0)
+
+    def _countsForDeck(self, did):
+        return self._deckCounts.get(int(did), dict(new=0, lrnNow=0, dayLrn=0, rev=0))
+
     def deckDueList(self):
         "Returns [deckname, did, rev, lrn, new]"
         self._checkDay()
         self.col.decks.check_integrity()
+        # after the integrity check, which may move orphaned cards to the default deck
+        self._loadDeckCounts()
         decks = self.col.decks.all()
         decks.sort(key=itemgetter("name"))
         lims = {}
@@ -124,11 +166,7 @@ class Scheduler:
         return data
 
     def _resetNewCount(self):
-        cntFn = lambda did, lim: self.col.db.scalar(
-            f"select least(count(0), %s) from {self.col.username}.cards where did = %s and queue = 0",
-            lim,
-            did,
-        )
+        cntFn = lambda did, lim: min(self._countsForDeck(did)["new"], lim)
         self.newCount = self._walkingCount(self._deckNewLimitSingle, cntFn)
 
     def _resetNew(self):
@@ -152,9 +190,7 @@ class Scheduler:
         if not lim:
             return 0
         lim = min(lim, self.reportLimit)
-        return self.col.db.scalar(
-            f"""select count(0) from {self.col.username}.cards where did = %s and queue = 0 limit %s""", did, lim
-        )
+        return min(self._countsForDeck(did)["new"], lim)
 
     def _deckNewLimitSingle(self, g):
         "Limit for deck without parent limits."
@@ -164,23 +200,18 @@ class Scheduler:
         return max(0, c["new"]["perDay"] - g["newToday"][1])
 
     def _resetLrnCount(self):
-        # sub-day
+        # sub-day, over the first `reportLimit` cards of all the active decks together
         self.lrnCount = int(
             self.col.db.scalar(
                 f"""
                 select sum(remaining/1000) from (select remaining from {self.col.username}.cards where
-                did in {self._deckLimit()} and queue = 1 and due < %s limit {self.reportLimit}) as foo""",
+                did in {self._deckLimit()} and queue = 1 and due < %s order by id limit {self.reportLimit}) as foo""",
                 self.dayCutoff,
             )
             or 0
         )
         # day
-        self.lrnCount += self.col.db.scalar(
-            f"""
-            select count(0) from {self.col.username}.cards where did in {self._deckLimit()} and queue = 3
-            and due <= %s limit {self.reportLimit}""",
-            self.today,
-        )
+        self.lrnCount += sum(self._countsForDeck(did)["dayLrn"] for did in set(int(d) for d in self.col.decks.active()))
 
     def _resetLrn(self):
         self._resetLrnCount()
@@ -189,25 +220,8 @@ class Scheduler:
         self._lrnDids = self.col.decks.active()[:]
 
     def _lrnForDeck(self, did):
-        cnt = int(
-            self.col.db.scalar(
-                f"""select sum(remaining/1000) from
-                        (select remaining from {self.col.username}.cards
-                            where did = %s and queue = 1 and due < %s limit %s) as foo""",
-                did,
-                intTime() + self.col.conf["collapseTime"],
-                self.reportLimit,
-            )
-            or 0
-        )
-        return cnt + self.col.db.scalar(
-            f"""select count(0) from
-                {self.col.username}.cards where did = %s and queue = 3
-                and due <= %s limit %s""",
-            did,
-            self.today,
-            self.reportLimit,
-        )
+        counts = self._countsForDeck(did)
+        return counts["lrnNow"] + counts["dayLrn"]
 
     def _deckRevLimitSingle(self, d):
         if d["dyn"]:
@@ -217,24 +231,10 @@ class Scheduler:
 
     def _revForDeck(self, did, lim):
         lim = min(lim, self.reportLimit)
-        return self.col.db.scalar(
-            f""" select count(0) from {self.col.username}.cards where did = %s and queue = 2
-                and due <= %s limit %s""",
-            did,
-            self.today,
-            lim,
-        )
+        return min(self._countsForDeck(did)["rev"], lim)
 
     def _resetRevCount(self):
-        def cntFn(did, lim):
-            return self.col.db.scalar(
-                f"""
-                select count(0) from {self.col.username}.cards where
-                did = %s and queue = 2 and due <= %s limit {lim}""",
-                did,
-                self.today,
-            )
-
+        cntFn = lambda did, lim: min(self._countsForDeck(did)["rev"], lim)
         self.revCount = self._walkingCount(self._deckRevLimitSingle, cntFn)
 
     def _resetRev(self):
@@ -24,6 +24,7 @@ from rest_framework.test import APIRequestFactory, APITransactionTestCase
 from djankiserv_sync import views
 
 from djankiserv_unki import AnkiDataModel
+from djankiserv_unki.collection import Collection
 from djankiserv_unki.database import StandardDB, db_conn
 
 # copied from anki.consts
@@ -111,6 +112,8 @@ class TestRemoteServer(APITransactionTestCase, ABC):
                                 if table_name not in output:
                                     output[table_name] = {}
                                 output[table_name][COLS[i]] = (oclean, nclean)
+                        elif i > 8 and json.loads(left_db[table_name][0][i]) == json.loads(right_db[table_name][0][i]):
+                            continue  # the other json columns, which the json codec may have written differently
                         elif left_db[table_name][0][i] != right_db[table_name][0][i]:
                             if table_name not in output:
                                 output[table_name] = {}
@@ -133,10 +136,13 @@ class TestRemoteServer(APITransactionTestCase, ABC):
             cur.execute(AnkiDataModel.DROP_SCHEMA.format(schema_name=schema_name))
             StandardDB.create_schema(schema_name)
             cur.execute(f"TRUNCATE TABLE {schema_name}.col")
+            cur.execute(f"TRUNCATE TABLE {schema_name}.meta")
 
             cur.execute(
                 sql.replace("{schema_name}", schema_name).replace("{db_owner}", connection.settings_dict["USER"])
             )
+        # the assets predate the media counters of the meta table
+        Collection.repair_media_meta(StandardDB(), schema_name)
 
     def load_json_asset(self, fname):
         return json.loads(pkgutil.get_data(self.assets_package(), fname).decode("utf-8"))
@@ -245,6 +251,35 @@ class SyncTestRemoteServer(TestRemoteServer):
 
         self.assertFalse(diff)
 
+    def _chunked_chunk_test(self, test_set, chunk_size):
+        rs = TestRemoteSyncServer()
+
+        rs.hostKey(SyncTestRemoteServer.USERNAME, SyncTestRemoteServer.PASSWORD)
+        rs.meta()
+
+        self.load_db_asset(SyncTestRemoteServer.USERNAME, f"{test_set}/pre_chunk.sql")
+        rs.start(**self.load_json_asset(f"{test_set}/pre_start.json"))
+
+        before = self.load_db_to_dict()
+
+        expected = self.load_json_asset(f"{test_set}/post_chunk.json")
+        received = {"revlog": [], "cards": [], "notes": []}
+        with self.settings(DJANKISERV_SYNC_CHUNK_SIZE=chunk_size):
+            while True:
+                output = rs.chunk(**self.load_json_asset(f"{test_set}/pre_chunk.json"))
+                self.assertLessEqual(sum(len(v) for k, v in output.items() if k != "done"), chunk_size)
+                for table, rows in output.items():
+                    if table != "done":
+                        received[table] += rows
+                if output["done"]:
+                    break
+
+        for table, rows in received.items():
+            self.assertEqual(sorted(rows), sorted(expected[table]))
+
+        after = self.load_db_to_dict()
+        self.assertFalse(self.db_diff(before, after))
+
     def _standard_sanity_check2_test(self, test_set, to_review):
         rs = TestRemoteSyncServer()
         rs_method = rs.sanityCheck2
@@ -347,6 +382,7 @@ class SyncTestFullSyncer(SyncTestRemoteServer):
         cont = fss.download()
         self.maxDiff = None
         self.assertIsNotNone(cont)
+        self.assertFalse(os.path.exists(fss.download_path))  # the temp file is removed once streamed
 
         with tempfile.NamedTemporaryFile(suffix=".anki2", delete=False) as f:
             temp_db_path = f.name
@@ -580,6 +616,10 @@ class TestRemoteSyncServer(RemoteServer):
 
 
 class TestFullSyncer(RemoteServer):
+    def __init__(self):
+        super().__init__()
+        self.download_path = None
+
     def download(self):
         self.postVars = dict(k=self.hkey, s=self.skey)
 
@@ -590,7 +630,10 @@ class TestFullSyncer(RemoteServer):
         if ret.status_code != 200:
             # invalid auth or another issue
             return None
-        return ret.content
+        content = b"".join(ret.streaming_content)
+        self.download_path = ret.file_to_stream.name
+        ret.close()
+        return content
 
     def upload(self, bin_data):
         self.postVars = dict(k=self.hkey, s=self.skey)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Opt-in benchmarks, run with scripts/runbenchmarks.sh. They reuse the test database setup but are
+# not picked up by scripts/runtests.sh, as the modules are named `bench_*.py` rather than `test*.py`.
+# Set DJANKISERV_BENCH_SCALE to multiply the size of the synthetic collections.
+
+import json
+import os
+import pkgutil
+import tempfile
+import time
+from sqlite3 import dbapi2 as sqlite
+
+from djankiserv_unki.download import sqlite3_for_download
+
+from .. import TestRemoteServer
+
+BENCH_SCALE = int(os.getenv("DJANKISERV_BENCH_SCALE", "1"))
+
+
+def timed(fn, *a, **ka):
+    start = time.perf_counter()
+    res = fn(*a, **ka)
+    return time.perf_counter() - start, res
+
+
+def report(name, **results):
+    print(f"\n{name}: " + ", ".join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in results.items()))
+
+
+def synthetic_collection(n_notes, revlog_per_card=2):
+    "Write an .anki2 file with n_notes Basic notes, each with one card, and return its path"
+    path = tempfile.mktemp(suffix=".anki2")
+    sqlite3_for_download(path)
+
+    model = json.loads(pkgutil.get_data("djankiserv.assets.jsonfiles", "default_model.json").decode("utf-8"))
+    mid = int(list(model.keys())[0])
+    base = 1500000000000
+
+    with sqlite.connect(path) as conn:
+        conn.execute("update col set models = ?", (json.dumps(model),))
+        conn.executemany(
+            "insert into notes values (?,?,?,?,?,?,?,?,?,?,?)",
+            (
+                (
+                    base + i,
+                    f"g{i}",
+                    mid,
+                    1600000000,
+                    0,
+                    " bench ",
+                    f"<b>front</b> {i}\x1fback {i}",
+                    f"front {i}",
+                    1,
+                    0,
+                    "",
+                )
+                for i in range(n_notes)
+            ),
+        )
+        conn.executemany(
+            "insert into cards values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+            (
+                (base + i, base + i, 1, 0, 1600000000, 0, 2, 2, i % 365, 10, 2500, 3, 0, 0, 0, 0, 0, "")
+                for i in range(n_notes)
+            ),
+        )
+        conn.executemany(
+            "insert into revlog values (?,?,?,?,?,?,?,?,?)",
+            (
+                (base + i * revlog_per_card + j, base + i, 0, 3, 10, 5, 2500, 6000, 1)
+                for i in range(n_notes)
+                for j in range(revlog_per_card)
+            ),
+        )
+    return path
+
+
+class BenchmarkCase(TestRemoteServer):
+    def assets_package(self):
+        return "assets"
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+
+from djankiserv_unki.collection import Collection
+
+from . import BENCH_SCALE, BenchmarkCase, report, timed
+
+
+def per_note_create_notes(col, notes_json, deck_name):
+    "The previous implementation of the notes/add view, a `Note` flushed and a save for each note"
+    note_ids = []
+    for note_json in notes_json:
+        model = col.models.by_name(note_json["model"])
+        deck_id = col.decks.get_or_add(deck_name)
+        note = col.new_note(model)
+        note.model()["did"] = deck_id
+        for field in col.models.field_map(model).values():
+            note[field[1]["name"]] = note_json["fields"][field[0]]
+        for tag in note_json["tags"]:
+            if tag.strip():
+                note.tags.append(tag)
+        col.add_note(note)
+        col.save()
+        note_ids.append(note.id)
+    return note_ids
+
+
+class AddNotesBenchmark(BenchmarkCase):
+    def test_add_notes(self):
+        n_notes = 2000 * BENCH_SCALE
+        notes = [
+            {"model": "Basic", "fields": [f"<b>front</b> {i}", f"back {i}"], "tags": ["bench"]} for i in range(n_notes)
+        ]
+
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            per_note, _ = timed(per_note_create_notes, col, notes, "Per note")
+            bulk, _ = timed(col.create_notes, notes, "Bulk")
+            self.assertEqual(col.db.scalar(f"select count(*) from {col.username}.cards"), 2 * n_notes)
+
+        report("create_notes", notes=n_notes, per_note=per_note, bulk=bulk)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from unittest import mock
+
+from django.conf import settings
+
+import djankiserv_unki
+from djankiserv_sync import SyncCollectionHandler
+from djankiserv_unki import ids2str
+from djankiserv_unki.collection import Collection
+from djankiserv_unki.database import StandardDB
+
+from . import BENCH_SCALE, BenchmarkCase, report, timed
+
+
+def executemany_upsert(self, schema_name, table_name, rows, update=True):
+    "The previous upsert, one INSERT ... ON CONFLICT per row through `executemany`"
+    if update:
+        sql = djankiserv_unki.AnkiDataModel.insert_on_conflict_update(schema_name, table_name)
+    else:
+        sql = djankiserv_unki.AnkiDataModel.insert_on_conflict_nothing(schema_name, table_name)
+    self.executemany(sql, rows)
+
+
+def executemany_merge(self, schema_name, table_name, rows, min_usn):
+    "The previous merge path, getting the existing mods with a giant IN list before upserting row by row"
+    mod_idx = 3 if table_name == "notes" else 4
+    lmods = dict(
+        self.execute(
+            f"""select id, modified from {schema_name}.{table_name}
+                where id in {ids2str(r[0] for r in rows)} and usn >= {min_usn}"""
+        ).fetchall()
+    )
+    rows = [r for r in rows if r[0] not in lmods or lmods[r[0]] < r[mod_idx]]
+    executemany_upsert(self, schema_name, table_name, rows)
+    return [r[0] for r in rows]
+
+
+class ApplyChunkBenchmark(BenchmarkCase):
+    def _apply_chunk(self, n_cards, base):
+        chunk = {
+            "cards": [
+                [base + i, base + i, 1, 0, 1600000000, -1, 2, 2, i % 365, 10, 2500, 3, 0, 0, 0, 0, 0, ""]
+                for i in range(n_cards)
+            ],
+            "revlog": [[base + i, base + i, -1, 3, 10, 5, 2500, 6000, 1] for i in range(n_cards)],
+        }
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            handler = SyncCollectionHandler(col)
+            handler.min_usn = 0
+            elapsed, _ = timed(handler.applyChunk, chunk)
+        return elapsed
+
+    def test_apply_chunk(self):
+        n_cards = 50000 * BENCH_SCALE
+        with mock.patch.object(StandardDB, "upsert", executemany_upsert), mock.patch.object(
+            StandardDB, "merge", executemany_merge
+        ):
+            executemany = self._apply_chunk(n_cards, 1500000000000)
+        multi_row = self._apply_chunk(n_cards, 1600000000000)
+
+        report("applyChunk", cards=n_cards, revlog=n_cards, executemany=executemany, multi_row=multi_row)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import base64
+
+from django.urls import reverse
+
+from . import BENCH_SCALE, BenchmarkCase, report, timed
+
+
+class AuthCacheBenchmark(BenchmarkCase):
+    def _tags(self, n_requests):
+        url = reverse("tags")
+        for _ in range(n_requests):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+    def test_basic_auth_tags(self):
+        n_requests = 50 * BENCH_SCALE
+        self.client.credentials(
+            HTTP_AUTHORIZATION=b"Basic " + base64.b64encode(f"{self.USERNAME}:{self.PASSWORD}".encode())
+        )
+        self._tags(1)  # opens the collection
+
+        with self.settings(DJANKISERV_AUTH_CACHE_TTL=0):
+            uncached, _ = timed(self._tags, n_requests)
+        cached, _ = timed(self._tags, n_requests)
+
+        report(
+            "/api/v1/tags with basic auth",
+            requests=n_requests,
+            uncached_rps=n_requests / uncached,
+            cached_rps=n_requests / cached,
+        )
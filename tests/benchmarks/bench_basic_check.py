@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from django.conf import settings
+
+from djankiserv_sync import full_upload
+from djankiserv_unki import ids2str
+from djankiserv_unki.collection import Collection
+
+from . import BENCH_SCALE, BenchmarkCase, report, synthetic_collection, timed
+
+
+def not_in_basic_check(col):
+    "The previous implementation of `Collection.basic_check`, with NOT IN subqueries and a query per model"
+    if col.db.scalar(
+        f"select 1 from {col.username}.cards where nid not in (select id from {col.username}.notes) limit 1"
+    ):
+        return False
+    if col.db.scalar(
+        f"""select 1 from {col.username}.notes where id not in (select distinct nid from {col.username}.cards)
+            or mid not in {ids2str(col.models.ids())} limit 1"""
+    ):
+        return False
+    for model in col.models.all():
+        if model["type"] != 0:
+            continue
+        if col.db.scalar(
+            f"""select 1 from {col.username}.cards where ord not in {ids2str([t["ord"] for t in model["tmpls"]])}
+                and nid in (select id from {col.username}.notes where mid = %s) limit 1""",
+            model["id"],
+        ):
+            return False
+    return True
+
+
+# With the default work_mem, the NOT IN subqueries stop being hashed somewhere past half a million cards, and the
+# previous implementation then goes quadratic (it hadn't finished after 5 minutes for BENCH_SCALE=4).
+class BasicCheckBenchmark(BenchmarkCase):
+    def test_basic_check(self):
+        path = synthetic_collection(200000 * BENCH_SCALE, revlog_per_card=0)
+        with open(path, "rb") as fh:
+            full_upload(fh, self.user.username)
+        os.remove(path)
+
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            col.db.execute(f"analyze {col.username}.cards")
+            col.db.execute(f"analyze {col.username}.notes")
+            not_in, old_ok = timed(not_in_basic_check, col)
+            not_exists, new_ok = timed(col.basic_check)
+
+        self.assertTrue(old_ok and new_ok)
+        report("basic_check", cards=200000 * BENCH_SCALE, not_in=not_in, not_exists=not_exists)
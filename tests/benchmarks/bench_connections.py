@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+from django.core.signals import request_finished, request_started
+
+from djankiserv_unki.database import connection_stats, db_conn
+
+from .. import TestRemoteSyncServer
+from . import BENCH_SCALE, BenchmarkCase, report, timed
+
+TEST_SET = "two_notes_two_studied"
+
+
+def as_request(fn, **kw):
+    "Call a sync method with the signals a WSGI server sends around each request, which the test client doesn't"
+    request_started.send(sender=None)
+    try:
+        return fn(**kw)
+    finally:
+        request_finished.send(sender=None)
+
+
+class ConnectionsBenchmark(BenchmarkCase):
+    def assets_package(self):
+        return "assets.down"
+
+    def _sync(self):
+        self.load_db_asset(self.user.username, f"{TEST_SET}/pre_start.sql")
+
+        rs = TestRemoteSyncServer()
+        as_request(rs.hostKey, user=self.USERNAME, pw=self.PASSWORD)
+        as_request(rs.meta)
+        as_request(rs.start, **self.load_json_asset(f"{TEST_SET}/pre_start.json"))
+        as_request(rs.applyGraves, **self.load_json_asset(f"{TEST_SET}/pre_applyGraves.json"))
+        as_request(rs.applyChanges, **self.load_json_asset(f"{TEST_SET}/pre_applyChanges.json"))
+        while not as_request(rs.chunk)["done"]:
+            pass
+        as_request(rs.applyChunk, **self.load_json_asset(f"{TEST_SET}/pre_applyChunk.json"))
+        as_request(rs.sanityCheck2, **self.load_json_asset(f"{TEST_SET}/pre_sanityCheck2.json"))
+        as_request(rs.finish)
+
+    def _run_syncs(self, conn_max_age, n_syncs):
+        conn = db_conn()
+        conn.close()
+        conn.settings_dict["CONN_MAX_AGE"] = conn_max_age
+        opened = connection_stats.stats()["opened"]
+        elapsed, _ = timed(lambda: [self._sync() for _ in range(n_syncs)])
+        return elapsed / n_syncs * 1000, connection_stats.stats()["opened"] - opened
+
+    def test_full_sync_flow(self):
+        n_syncs = 20 * BENCH_SCALE
+        conn_max_age = db_conn().settings_dict["CONN_MAX_AGE"]
+        try:
+            per_request_ms, per_request_opened = self._run_syncs(0, n_syncs)
+            persistent_ms, persistent_opened = self._run_syncs(600, n_syncs)
+        finally:
+            db_conn().settings_dict["CONN_MAX_AGE"] = conn_max_age
+
+        report(
+            "full sync flow",
+            syncs=n_syncs,
+            per_request_ms=per_request_ms,
+            per_request_opened=per_request_opened,
+            persistent_ms=persistent_ms,
+            persistent_opened=persistent_opened,
+        )
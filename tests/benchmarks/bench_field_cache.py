@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from django.conf import settings
+
+from djankiserv_sync import full_upload
+from djankiserv_unki import fieldChecksum, ids2str, splitFields, stripHTMLMedia
+from djankiserv_unki.collection import Collection
+
+from . import BENCH_SCALE, BenchmarkCase, report, synthetic_collection, timed
+
+
+def executemany_update_field_cache(col, nids):
+    "The previous implementation of `Collection.update_field_cache`, serial and with an UPDATE per note"
+    r = []
+    for (nid, mid, flds) in col.db.execute(
+        f"select id, mid, flds from {col.username}.notes where id in {ids2str(nids)}"
+    ):
+        fields = splitFields(flds)
+        model = col.models.get(mid)
+        r.append((stripHTMLMedia(fields[col.models.sort_idx(model)]), fieldChecksum(fields[0]), nid))
+    col.db.executemany(f"update {col.username}.notes set sfld=%s, csum=%s where id=%s", r)
+
+
+class FieldCacheBenchmark(BenchmarkCase):
+    def test_update_field_cache(self):
+        n_notes = 100000 * BENCH_SCALE
+        path = synthetic_collection(n_notes, revlog_per_card=0)
+        with open(path, "rb") as fh:
+            full_upload(fh, self.user.username)
+        os.remove(path)
+
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            nids = col.all_note_ids()
+            executemany, _ = timed(executemany_update_field_cache, col, nids)
+            batched, _ = timed(col.update_field_cache, nids)
+            with self.settings(DJANKISERV_FIELD_CACHE_PROCESSES=4):
+                processes, _ = timed(col.update_field_cache, nids)
+
+        report("update_field_cache", notes=n_notes, executemany=executemany, batched=batched, processes_4=processes)
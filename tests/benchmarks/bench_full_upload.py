@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+from unittest import mock
+
+import djankiserv_unki
+from djankiserv_sync import full_upload
+from djankiserv_unki import AnkiDataModelBase
+
+from . import BENCH_SCALE, BenchmarkCase, report, synthetic_collection, timed
+
+
+class FullUploadBenchmark(BenchmarkCase):
+    def test_full_upload(self):
+        path = synthetic_collection(20000 * BENCH_SCALE)
+        with open(path, "rb") as fh:
+            data = fh.read()
+        os.remove(path)
+
+        with mock.patch.object(djankiserv_unki.AnkiDataModel, "bulk_insert", AnkiDataModelBase.bulk_insert):
+            executemany, _ = timed(full_upload, io.BytesIO(data), self.user.username)
+        bulk_insert, _ = timed(full_upload, io.BytesIO(data), self.user.username)
+
+        report("full_upload", mb=round(len(data) / 1024 / 1024, 1), executemany=executemany, bulk_insert=bulk_insert)
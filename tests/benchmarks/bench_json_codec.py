@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from djankiserv_sync import SyncCollectionHandler, full_upload
+from djankiserv_unki import codec
+from djankiserv_unki.collection import Collection
+
+from . import BENCH_SCALE, BenchmarkCase, report, synthetic_collection, timed
+
+
+class JsonCodecBenchmark(BenchmarkCase):
+    def test_chunk_response(self):
+        path = synthetic_collection(25000 * BENCH_SCALE)  # 25k notes, 25k cards and 50k revlog rows
+        with open(path, "rb") as fh:
+            full_upload(fh, self.user.username)
+        os.remove(path)
+
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            handler = SyncCollectionHandler(col, chunk_size=100000 * BENCH_SCALE)
+            handler.start(min_usn=0, lnewer=False, offset=None)
+            chunk = handler.chunk()
+
+        results = {"rows": sum(len(v) for k, v in chunk.items() if k != "done")}
+        results["django_dumps"], data = timed(lambda: JsonResponse(chunk).content)
+        for name in "json", "orjson":
+            try:
+                c = codec.get_codec(name)
+            except ImportError:
+                continue
+            results[f"{name}_dumps"], data = timed(c.dumps_bytes, chunk)
+            results[f"{name}_loads"], _ = timed(c.loads, data)
+        results["kb"] = len(data) // 1024
+
+        report("json_codec chunk", **results)
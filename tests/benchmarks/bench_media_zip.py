@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import djankiserv_sync
+from djankiserv_sync import media_zip
+
+from . import BENCH_SCALE, BenchmarkCase, report, timed
+
+
+class MediaZipBenchmark(BenchmarkCase):
+    def test_media_zip(self):
+        # a batch of files that do get deflated (svg, html, wav...), about as much as fits in a zip
+        words = [f"word{i}".encode() for i in range(5000)]
+        n_zips = 10 * BENCH_SCALE
+        with tempfile.TemporaryDirectory() as media_dir:
+            fnames = []
+            for i in range(djankiserv_sync.SYNC_ZIP_COUNT):
+                fnames.append(f"{i}.svg")
+                with open(os.path.join(media_dir, fnames[-1]), "wb") as fh:
+                    fh.write(b" ".join(random.choices(words, k=12000)))
+
+            def build():
+                for _ in range(n_zips):
+                    media_zip(media_dir, fnames).close()
+
+            results = {"files": len(fnames), "zips": n_zips}
+            for threads in 1, 4:
+                with mock.patch.object(djankiserv_sync, "media_zip_executor", ThreadPoolExecutor(threads)):
+                    results[f"threads_{threads}_s"], _ = timed(build)
+
+        report("media_zip", **results)
@@ -2,11 +2,16 @@
 
 import base64
 import json
+import pickle
 import time
+from unittest import mock
 
+from django.contrib.auth import authenticate, base_user
 from django.urls import reverse
 from rest_framework import status
 
+from djankiserv_api.auth import credentials_cache
+
 from . import TestRemoteServer
 
 
@@ -219,3 +224,66 @@ class ApiTest(TestRemoteServer):
         for note in returned["notes"]:
             del note["id"]
         self.assertEqual(ref_data, returned)
+
+    def test_stats(self):
+        url = reverse("stats")
+        self.client.login(username=super().USERNAME, password=super().PASSWORD)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        returned = json.loads(response.content.decode("utf8"))
+        self.assertIn("hits", returned["collection_cache"])
+        self.assertIn("reused", returned["userdata_connections"])
+        self.assertIn("bytes_out", returned["sync_compression"])
+        self.assertIn("hits", returned["sync_sessions"])
+        self.assertIn("hits", returned["auth_cache"])
+
+
+class AuthCacheTest(TestRemoteServer):
+    def assets_package(self):
+        return "assets.api"
+
+    def authenticate(self, password, hashed):
+        with mock.patch.object(base_user, "check_password", wraps=base_user.check_password) as check_password:
+            user = authenticate(username=self.USERNAME, password=password)
+        self.assertEqual(check_password.called, hashed)
+        return user
+
+    def test_verification_cached(self):
+        self.assertEqual(self.authenticate(self.PASSWORD, hashed=True), self.user)
+        self.assertEqual(self.authenticate(self.PASSWORD, hashed=False), self.user)
+        self.assertIsNone(self.authenticate("wrong", hashed=True))
+        self.assertIsNone(self.authenticate("wrong", hashed=True))  # failures aren't cached
+
+        with self.settings(DJANKISERV_AUTH_CACHE_TTL=0):
+            self.assertEqual(self.authenticate(self.PASSWORD, hashed=True), self.user)
+
+    def test_password_change(self):
+        self.assertEqual(self.authenticate(self.PASSWORD, hashed=True), self.user)
+        self.user.set_password("a_new_pass_word")
+        self.user.save()
+        self.assertIsNone(self.authenticate(self.PASSWORD, hashed=True))
+        self.assertEqual(self.authenticate("a_new_pass_word", hashed=True), self.user)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(self.authenticate("a_new_pass_word", hashed=True))
+
+    def test_hash_not_cached(self):
+        self.authenticate(self.PASSWORD, hashed=True)
+        cached = pickle.dumps(credentials_cache._entries)  # pylint: disable=W0212
+        self.assertNotIn(self.user.password.encode(), cached)
+        self.assertNotIn(self.PASSWORD.encode(), cached)
+
+    def test_basic_auth(self):
+        self.client.credentials(
+            HTTP_AUTHORIZATION=b"Basic " + base64.b64encode(f"{self.USERNAME}:{self.PASSWORD}".encode())
+        )
+        for _ in range(2):
+            response = self.client.get(reverse("tags"))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.authenticate(self.PASSWORD, hashed=False), self.user)
@@ -1,16 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import gzip
 import io
 import json
 import os
+import tempfile
 import time
 import zipfile
+from unittest import mock
 
+from asgiref.sync import async_to_sync
 from django.conf import settings
-
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+import djankiserv_sync
+from djankiserv_sync import media_zip, views
+from djankiserv_sync.compression import compression_stats
+from djankiserv_sync.sessions import session_cache
+from djankiserv_sync.views import asynchronous
 from djankiserv_unki.database import db_conn
 
-from . import SyncTestRemoteServer, TestRemoteMediaServer, TestRemoteSyncServer
+from . import SyncTestRemoteServer, TestFullSyncer, TestRemoteMediaServer, TestRemoteSyncServer
 
 
 class SyncTestRemoteServerDown(SyncTestRemoteServer):
@@ -329,6 +341,9 @@ class SyncTestRemoteSyncServerDown(SyncTestRemoteServerDown):  # pylint: disable
     def test_chunk_modify_deck_conf(self):
         self._standard_chunk_test("modify_deck_conf")
 
+    def test_chunk_two_notes_two_studied_small_chunks(self):
+        self._chunked_chunk_test("two_notes_two_studied", chunk_size=1)
+
     ##
     ## test the `applyChunk` methods
     ##
@@ -441,13 +456,16 @@ class SyncTestRemoteMediaServerDown(SyncTestRemoteServerDown):
 
         before = self.load_db_to_dict()
 
-        output = rs_method(**self.load_json_asset(f"{test_set}/pre_{rs_method.__name__}.json")).content
+        resp = rs_method(**self.load_json_asset(f"{test_set}/pre_{rs_method.__name__}.json"))
+        output = b"".join(resp.streaming_content)
 
         z = zipfile.ZipFile(io.BytesIO(output), "r")
         meta = json.loads(z.read("_meta").decode("utf8"))
         self.assertEqual(len(z.infolist()), 2)
         self.assertEqual(meta["0"], fname)
         self.assertEqual(z.read("0"), self.get_asset(fname))
+        # pngs are compressed already, so they are stored as is
+        self.assertEqual(z.getinfo("0").compress_type, zipfile.ZIP_STORED)
 
         # no db change expected
         after = self.load_db_to_dict()
@@ -459,6 +477,30 @@ class SyncTestRemoteMediaServerDown(SyncTestRemoteServerDown):
     def test_downloadFiles_two_notes_one_added(self):
         self._standard_download_files_down_test("two_notes_one_added", "wo2.png")
 
+    def test_media_zip(self):
+        self._media_zip_test()
+        with mock.patch.object(djankiserv_sync, "PARALLEL_MEDIA_ZIP", False):  # e.g. on a newer python
+            self._media_zip_test()
+
+    def _media_zip_test(self):
+        files = {f"{i}.txt": os.urandom(100) * (1000 + i) for i in range(10)}
+        files.update({"a.png": os.urandom(5000), "b.mp3": b"", "c.svg": b"<svg/>"})
+        with tempfile.TemporaryDirectory() as media_dir:
+            for fname, data in files.items():
+                with open(os.path.join(media_dir, fname), "wb") as fh:
+                    fh.write(data)
+            with zipfile.ZipFile(media_zip(media_dir, list(files))) as z:
+                self.assertIsNone(z.testzip())
+                meta = json.loads(z.read("_meta"))
+                self.assertEqual(list(meta.values()), list(files))  # in the order they were asked for
+                for name, fname in meta.items():
+                    self.assertEqual(z.read(name), files[fname])
+                    self.assertEqual(
+                        z.getinfo(name).compress_type,
+                        zipfile.ZIP_STORED if fname[-4:] in (".png", ".mp3") else zipfile.ZIP_DEFLATED,
+                    )
+                self.assertLess(z.getinfo("0").compress_size, 1000)
+
     ##
     ## test the `mediaChanges` methods
     ##
@@ -494,6 +536,23 @@ class SyncTestRemoteMediaServerDown(SyncTestRemoteServerDown):
             "two_notes_one_added", [["wo2.png", 2, "f18e0dc430b26c75e16315bd6367bdcc744ea2c8"]]
         )
 
+    def test_mediaChanges_paged(self):
+        rms = TestRemoteMediaServer()
+        rms.hostKey(SyncTestRemoteServer.USERNAME, SyncTestRemoteServer.PASSWORD)
+        rms.meta()
+        rms.begin()
+        self.load_db_asset(SyncTestRemoteServer.USERNAME, "one_note_delete_unused_media/pre_mediaChanges.sql")
+
+        # like the clients, ask again from the last usn received until there are no more changes
+        received = []
+        with self.settings(DJANKISERV_MEDIA_CHANGES_PAGE_SIZE=1):
+            changes = rms.mediaChanges(lastUsn=0)["data"]
+            while changes:
+                self.assertEqual(len(changes), 1)
+                received += changes
+                changes = rms.mediaChanges(lastUsn=changes[-1][1])["data"]
+        self.assertEqual(received, [["wo1.png", 1, "f18e0dc430b26c75e16315bd6367bdcc744ea2c8"], ["wo2.png", 3, None]])
+
     ##
     ## test the `mediaSanity` methods
     ##
@@ -505,3 +564,111 @@ class SyncTestRemoteMediaServerDown(SyncTestRemoteServerDown):
 
     def test_mediaSanity_two_notes_one_added(self):
         self._standard_media_sanity_test("two_notes_one_added")
+
+
+class SyncTestAsyncViews(SyncTestRemoteServerDown):
+    def test_async_meta(self):
+        rs = TestRemoteSyncServer()
+        rs.hostKey(SyncTestRemoteServer.USERNAME, SyncTestRemoteServer.PASSWORD)
+        expected = rs.meta()
+        for key in "ts", "mod":  # opening the collection the first time modifies it
+            expected.pop(key)
+
+        # the requests use the db, so must be built before getting into the event loop
+        requests = [rs.generic(io.BytesIO(b"{}")) for _ in range(3)]
+
+        async def concurrent_metas():
+            return await asyncio.gather(*(asynchronous.base_meta(request) for request in requests))
+
+        for resp in async_to_sync(concurrent_metas)():
+            output = json.loads(resp.content.decode("utf8"))
+            self.assertEqual({k: v for k, v in output.items() if k in expected}, expected)
+
+
+class SyncTestCompression(SyncTestRemoteServerDown):
+    @staticmethod
+    def request(rs, data, accept_encoding):
+        req = rs.generic(io.BytesIO(json.dumps(data).encode("utf8")))
+        if accept_encoding:
+            req.META["HTTP_ACCEPT_ENCODING"] = accept_encoding
+        return req
+
+    def test_gzip_negotiated(self):
+        rs = TestRemoteSyncServer()
+        rs.hostKey(SyncTestRemoteServer.USERNAME, SyncTestRemoteServer.PASSWORD)
+        rs.meta()
+        start = dict(minUsn=0, lnewer=True, offset=None)
+
+        with self.settings(DJANKISERV_SYNC_GZIP_MIN_SIZE=0):
+            resp = views.base_start(self.request(rs, start, None))
+            self.assertFalse(resp.has_header("Content-Encoding"))
+            self.assertIn("Accept-Encoding", resp["Vary"])
+            expected = json.loads(resp.content)
+
+            compressed = compression_stats.stats()["compressed"]
+            resp = views.base_start(self.request(rs, start, "gzip, deflate"))
+            self.assertEqual(resp["Content-Encoding"], "gzip")
+            self.assertEqual(int(resp["Content-Length"]), len(resp.content))
+            self.assertEqual(json.loads(gzip.decompress(resp.content)), expected)
+            self.assertEqual(compression_stats.stats()["compressed"], compressed + 1)
+
+        resp = views.base_start(self.request(rs, start, "gzip"))  # below the default threshold
+        self.assertFalse(resp.has_header("Content-Encoding"))
+        self.assertEqual(json.loads(resp.content), expected)
+
+    def test_gzip_download(self):
+        fss = TestFullSyncer()
+        fss.hostKey(SyncTestRemoteServer.USERNAME, SyncTestRemoteServer.PASSWORD)
+        fss.meta()
+        expected = fss.download()
+
+        resp = views.base_download(self.request(fss, dict(v="test"), "gzip"))
+        self.assertEqual(resp["Content-Encoding"], "gzip")
+        self.assertFalse(resp.has_header("Content-Length"))
+        content = b"".join(resp.streaming_content)
+        resp.close()
+        self.assertLess(len(content), len(expected))
+        self.assertEqual(gzip.decompress(content)[:16], expected[:16])
+        self.assertEqual(len(gzip.decompress(content)), len(expected))
+
+
+class SyncTestSessions(SyncTestRemoteServerDown):
+    @staticmethod
+    def session_queries(rs, view, **data):
+        req = rs.generic(io.BytesIO(json.dumps(data).encode("utf8")))  # saves a session of the test client
+        with CaptureQueriesContext(connection) as ctx:
+            resp = view(req)
+        queries = [q["sql"].split()[0] for q in ctx.captured_queries if "django_session" in q["sql"]]
+        return json.loads(resp.content), queries
+
+    def test_session_queries(self):
+        rs = TestRemoteSyncServer()
+        rs.hostKey(SyncTestRemoteServer.USERNAME, SyncTestRemoteServer.PASSWORD)
+        rs.postVars = dict(k=rs.hkey, s=rs.skey)
+
+        self.assertEqual(self.session_queries(rs, views.base_meta)[1], [])  # the host key is cached
+        start = dict(minUsn=0, lnewer=True, offset=None)
+        self.assertEqual(self.session_queries(rs, views.base_start, **start)[1], ["UPDATE"])
+        output, queries = self.session_queries(rs, views.base_chunk)
+        self.assertTrue(output["done"])
+        self.assertEqual(queries, ["SELECT", "UPDATE"])
+        self.assertEqual(self.session_queries(rs, views.base_sanityCheck2, client=None)[1], ["SELECT"])
+
+        session_cache.clear()  # e.g. a request served by another process
+        output, queries = self.session_queries(rs, views.base_chunk)
+        self.assertEqual(queries, ["SELECT"])  # the cursor hasn't changed
+        self.assertEqual(output, {"done": True})
+
+    def test_shared_cache(self):
+        with self.settings(DJANKISERV_SYNC_SESSION_CACHE="default"):
+            rs = TestRemoteSyncServer()
+            rs.hostKey(SyncTestRemoteServer.USERNAME, SyncTestRemoteServer.PASSWORD)
+            rs.postVars = dict(k=rs.hkey, s=rs.skey)
+
+            start = dict(minUsn=0, lnewer=True, offset=None)
+            self.assertEqual(self.session_queries(rs, views.base_start, **start)[1], [])
+            session_cache.clear()
+            output, queries = self.session_queries(rs, views.base_chunk)
+            self.assertEqual(queries, ["SELECT"])  # only the host key, the state is in the shared cache
+            self.assertTrue(output["done"])
+            self.assertEqual(self.session_queries(rs, views.base_chunk)[1], [])
@@ -0,0 +1,576 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import gzip
+import io
+import json
+import math
+import os
+import shutil
+import tempfile
+import zipfile
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from rest_framework.parsers import MultiPartParser
+from rest_framework.request import Request
+
+from djankiserv_unki import checksum, codec, fieldChecksum, get_data, get_data_file, intTime, stripHTMLMedia
+from djankiserv_unki.cache import CollectionCache, LRUCache, collection_cache
+from djankiserv_unki.collection import Collection
+from djankiserv_unki.database import StandardDB, connection_stats, db_conn
+from djankiserv_unki.mediastore import MediaStore
+
+from . import TestRemoteServer
+
+
+class LRUCacheTest(SimpleTestCase):
+    def test_tags(self):
+        cache = LRUCache(max_entries=10)
+        cache.put("a", [1])
+        cache.put("b", [2], tag=(1, 1))
+        self.assertEqual(cache.get("a"), [1])
+        self.assertIsNone(cache.get("b"))  # put with a tag
+        self.assertEqual(cache.get("b", tag=(1, 1)), [2])
+        self.assertEqual((cache.stats()["hits"], cache.stats()["misses"]), (2, 1))
+
+
+class CollectionCacheTest(SimpleTestCase):
+    def test_hit_and_miss(self):
+        cache = CollectionCache(max_entries=10)
+        self.assertIsNone(cache.get("user", (1, 1)))
+        cache.put("user", (1, 1), ({"a": 1},))
+        self.assertEqual(cache.get("user", (1, 1)), ({"a": 1},))
+        self.assertIsNone(cache.get("user", (2, 1)))  # the collection has been modified since
+        self.assertEqual((cache.stats()["hits"], cache.stats()["misses"]), (1, 2))
+
+    def test_returns_copies(self):
+        cache = CollectionCache(max_entries=10)
+        cache.put("user", (1, 1), {"a": 1})
+        cache.get("user", (1, 1))["a"] = 2
+        self.assertEqual(cache.get("user", (1, 1)), {"a": 1})
+
+    def test_bounds(self):
+        cache = CollectionCache(max_entries=2, max_bytes=1000)
+        for i in range(3):
+            cache.put(f"user{i}", (1, 1), i)
+        self.assertIsNone(cache.get("user0", (1, 1)))  # least recently used was evicted
+        self.assertEqual(cache.get("user2", (1, 1)), 2)
+
+        cache.put("big", (1, 1), "x" * 2000)
+        self.assertIsNone(cache.get("big", (1, 1)))
+        self.assertLessEqual(cache.stats()["bytes"], 1000)
+
+    def test_invalidate(self):
+        cache = CollectionCache(max_entries=10)
+        cache.put("user", (1, 1), 1)
+        cache.invalidate("user")
+        self.assertIsNone(cache.get("user", (1, 1)))
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+
+class GetDataTest(SimpleTestCase):
+    @staticmethod
+    def request(data, compression):
+        request = RequestFactory().post("/", {"c": str(compression), "data": SimpleUploadedFile("data", data)})
+        return request, Request(request, parsers=[MultiPartParser()])
+
+    def test_decoded_once(self):
+        request, drf_request = self.request(gzip.compress(b'{"minUsn": 0, "lnewer": true}'), 1)
+        data = get_data(drf_request)
+        self.assertEqual(data, {"minUsn": 0, "lnewer": True})
+        self.assertIs(get_data(request), data)
+        self.assertIs(get_data(drf_request), data)
+        self.assertEqual(get_data_file(request).read(), b'{"minUsn": 0, "lnewer": true}')
+
+    def test_binary_payload(self):
+        payload = b"SQLite format 3\x00" + os.urandom(1024)
+        request, _ = self.request(gzip.compress(payload), 1)
+        f = get_data(request)["data"]
+        self.assertEqual(f.read(), payload)
+        self.assertIs(get_data(request)["data"], f)
+        self.assertEqual(f.tell(), 0)  # handed out rewound
+        self.assertEqual(get_data(self.request(payload, 0)[0])["data"].read(), payload)
+
+
+class CodecTest(SimpleTestCase):
+    def test_codecs_agree(self):
+        obj = {"1": {"name": "Défaut", "ids": [1500000000000, -1], "ratio": 2.5, "none": None}, "flag": True}
+        codecs = [codec.StdlibCodec()] + ([codec.OrjsonCodec()] if codec.orjson else [])
+        for c in codecs:
+            for other in codecs:
+                self.assertEqual(other.loads(c.dumps(obj)), obj)
+                self.assertEqual(other.loads(c.dumps_bytes(obj)), obj)
+
+    def test_orjson_fallback(self):
+        if not codec.orjson:
+            self.skipTest("orjson isn't installed")
+        c = codec.OrjsonCodec()
+        self.assertEqual(c.loads(c.dumps({"big": 2**70, 1: "int key"})), {"big": 2**70, "1": "int key"})
+        self.assertTrue(math.isnan(c.loads(b'{"a": NaN}')["a"]))
+        with self.assertRaises(ValueError):
+            c.loads(b"{not json")
+
+    def test_special_values(self):
+        when = datetime.datetime(2020, 1, 2, 3, 4, 5, 123456, tzinfo=datetime.timezone.utc)
+        obj = {"nan": math.nan, "inf": [math.inf, -math.inf], "when": when, "day": when.date(), "id": None}
+        codecs = [codec.StdlibCodec()] + ([codec.OrjsonCodec()] if codec.orjson else [])
+        for c in codecs:
+            for data in c.dumps(obj), c.dumps_bytes(obj).decode():
+                self.assertIn("NaN", data)  # not null
+                parsed = json.loads(data)
+                self.assertTrue(math.isnan(parsed["nan"]))
+                self.assertEqual(parsed["inf"], [math.inf, -math.inf])
+                self.assertEqual(parsed["when"], "2020-01-02T03:04:05.123Z")  # like DjangoJSONEncoder
+                self.assertEqual(parsed["day"], "2020-01-02")
+                self.assertIsNone(parsed["id"])
+
+    def test_get_codec(self):
+        self.assertEqual(codec.get_codec("json").name, "json")
+        self.assertEqual(codec.get_codec().name, "orjson" if codec.orjson else "json")
+        with self.assertRaises(ValueError):
+            codec.get_codec("yaml")
+
+    def test_json_response(self):
+        resp = codec.JsonResponse({"a": [1, 2]})
+        self.assertEqual(resp["Content-Type"], "application/json")
+        self.assertEqual(json.loads(resp.content), {"a": [1, 2]})
+        with self.assertRaises(TypeError):
+            codec.JsonResponse([1, 2])
+        self.assertEqual(json.loads(codec.JsonResponse([1, 2], safe=False).content), [1, 2])
+
+
+class CollectionLoadTest(TestRemoteServer):
+    def assets_package(self):
+        return "assets"
+
+    def test_cached_load(self):
+        # the first load of the day writes to the collection (unburying etc.), so gets a new cache key
+        Collection(self.user.username, settings.DJANKISERV_DATA_ROOT).close()
+        Collection(self.user.username, settings.DJANKISERV_DATA_ROOT).close()
+
+        hits = collection_cache.stats()["hits"]
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            col.decks.get(1)["name"] = "not saved"
+
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            self.assertEqual(col.decks.get(1)["name"], "Default")
+            col.tags["a_tag"] = 0
+            col.tags_changed = True
+        self.assertEqual(collection_cache.stats()["hits"], hits + 2)
+
+        # the save has changed the collection so it must be reloaded
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            self.assertIn("a_tag", col.tags)
+        self.assertEqual(collection_cache.stats()["hits"], hits + 2)
+
+
+class KnownSchemasTest(TestRemoteServer):
+    def assets_package(self):
+        return "assets"
+
+    def test_known_schemas(self):
+        self.assertTrue(StandardDB.schema_exists(self.user.username))
+        with CaptureQueriesContext(db_conn()) as queries:
+            self.assertTrue(StandardDB.schema_exists(self.user.username))
+        self.assertEqual(len(queries), 0)
+
+        StandardDB.delete_schema(self.user.username)
+        self.assertFalse(StandardDB.schema_exists(self.user.username))
+
+
+class ConnectionStatsTest(TestRemoteServer):
+    def assets_package(self):
+        return "assets"
+
+    def test_health_check(self):
+        conn = db_conn()
+        conn.ensure_connection()
+        before = connection_stats.stats()
+        connection_stats.request_started()
+        self.assertIsNotNone(conn.connection)
+
+        conn.connection.close()  # as if the server had gone away
+        connection_stats.request_started()
+        self.assertIsNone(conn.connection)
+        with conn.cursor() as cur:  # reconnects
+            cur.execute("select 1")
+
+        after = connection_stats.stats()
+        self.assertEqual(after["reused"] - before["reused"], 2)
+        self.assertEqual(after["unusable"] - before["unusable"], 1)
+        self.assertEqual(after["opened"] - before["opened"], 1)
+
+
+class UpsertTest(TestRemoteServer):
+    def assets_package(self):
+        return "assets"
+
+    def test_upsert(self):
+        username = self.user.username
+        db = StandardDB()
+        with self.settings(DJANKISERV_UPSERT_PAGE_SIZE=2):
+            db.upsert(username, "media", [[f"{i}.png", 1, "sum"] for i in range(5)])
+            db.upsert(username, "media", [["0.png", 2, None], ["0.png", 3, None], ["5.png", 3, "sum"]])  # last wins
+            db.upsert(username, "media", [["1.png", 4, None], ["6.png", 4, "sum"], ["6.png", 5, None]], update=False)
+        self.assertTrue(db.mod)
+        self.assertEqual(
+            sorted(db.execute(f"select fname, usn, csum from {username}.media").fetchall()),
+            [("0.png", 3, None)]
+            + [(f"{i}.png", 1, "sum") for i in range(1, 5)]
+            + [("5.png", 3, "sum"), ("6.png", 4, "sum")],
+        )
+
+    def test_merge(self):
+        username = self.user.username
+        db = StandardDB()
+        cards = [[i, 1, 1, 0, 100, 5, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, ""] for i in range(4)]
+        db.upsert(username, "cards", cards)
+        db.execute(f"update {username}.cards set usn = 2 where id = 3")  # already seen by the client
+
+        # cards 0-2 have changed since the client last synced (min_usn 4), and only its card 0 is more recent.
+        # Card 3 hasn't so is overwritten whatever its mod, card 4 is new
+        client = [[i, 2, 1, 0, mod, 6, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, ""] for i, mod in enumerate((101, 99, 100, 50))]
+        client.append([4, 2, 1, 0, 1, 6, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, ""])
+        with self.settings(DJANKISERV_UPSERT_PAGE_SIZE=2):
+            self.assertEqual(sorted(db.merge(username, "cards", client, 4)), [0, 3, 4])
+        self.assertEqual(
+            sorted(db.execute(f"select id, nid from {username}.cards").fetchall()),
+            [(0, 2), (1, 1), (2, 1), (3, 2), (4, 2)],
+        )
+
+
+class FieldCacheTest(TestRemoteServer):
+    def assets_package(self):
+        return "assets"
+
+    def test_update_field_cache(self):
+        username = self.user.username
+        fields = [["<b>front</b> &amp; <img src='a.png'>", "back"], ["plain", "<i>back</i> &lt;"]]
+        with Collection(username, settings.DJANKISERV_DATA_ROOT) as col:
+            nids = [col.create_note({"model": "Basic", "fields": f, "tags": []}, "Default") for f in fields]
+            col.db.execute(f"update {username}.notes set sfld = '', csum = ''")
+            col.models.get(col.models.by_name("Basic")["id"])["sortf"] = 1  # sort on the back instead
+
+            with self.settings(DJANKISERV_UPSERT_PAGE_SIZE=1, DJANKISERV_FIELD_CACHE_PROCESSES=2):
+                col.update_field_cache(nids)
+            self.assertEqual(
+                [tuple(r) for r in col.db.execute(f"select sfld, csum from {username}.notes order by id").fetchall()],
+                [("back", str(fieldChecksum(fields[0][0]))), ("back <", str(fieldChecksum("plain")))],
+            )
+        self.assertEqual(stripHTMLMedia(fields[0][0]), "front &  a.png ")
+
+
+class SchedulerCountsTest(TestRemoteServer):
+    def assets_package(self):
+        return "assets"
+
+    def _count_queries(self, col):
+        with CaptureQueriesContext(db_conn()) as queries:
+            col.sched.reset()
+            due = col.sched.deckDueList()
+        return len(queries), due
+
+    def test_query_count_independent_of_decks(self):
+        self.load_db_asset(self.user.username, "one_note_reviewed_one_deleted_sql.sql")
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            few, due = self._count_queries(col)
+            counts = col.sched.counts()
+            self.assertEqual(sum(row[2] for row in due), counts[2])  # no deck limits hit, so reviews match
+
+            for i in range(20):
+                col.decks.get_or_add(f"Parent::child{i}")
+            many, due = self._count_queries(col)
+
+        self.assertEqual(few, many)
+        self.assertEqual(len(due), 22)  # Default, Parent and its children
+
+    def test_learning_counts_capped(self):
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            n_cards = col.sched.reportLimit + 200
+            col.db.executemany(
+                f"insert into {col.username}.cards values (%s, %s, 1, 0, 0, 0, 1, 1, 0, 0, 0, 0, 0, %s, 0, 0, 0, '')",
+                [(i + 1, i + 1, 1000 * (1 + i % 3)) for i in range(n_cards)],
+            )
+            col.sched.reset()
+            due = col.sched.deckDueList()
+
+            # the queries of the client (and of the server before the counts were grouped)
+            lrn_count = col.db.scalar(
+                f"""select sum(remaining/1000) from (select remaining from {col.username}.cards where
+                did in {col.sched._deckLimit()} and queue = 1 and due < %s limit {col.sched.reportLimit}) as foo""",
+                col.sched.dayCutoff,
+            )
+            lrn_for_deck = col.db.scalar(
+                f"""select sum(remaining/1000) from (select remaining from {col.username}.cards
+                where did = 1 and queue = 1 and due < %s limit %s) as foo""",
+                intTime() + col.conf["collapseTime"],
+                col.sched.reportLimit,
+            )
+            uncapped = col.db.scalar(f"select sum(remaining/1000) from {col.username}.cards where queue = 1")
+
+        self.assertLess(lrn_count, uncapped)
+        self.assertEqual(col.sched.counts()[1], lrn_count)
+        self.assertEqual(due[0][3], lrn_for_deck)
+
+
+class CreateNotesTest(TestRemoteServer):
+    def assets_package(self):
+        return "assets"
+
+    @staticmethod
+    def _create_queries(col, count):
+        notes = [{"model": "Basic", "fields": [f"front {i}", "back"], "tags": []} for i in range(count)]
+        with CaptureQueriesContext(db_conn()) as queries:
+            col.create_notes(notes, "Imported")
+        return len(queries)
+
+    def test_create_notes(self):
+        username = self.user.username
+        with Collection(username, settings.DJANKISERV_DATA_ROOT) as col:
+            nids = col.create_notes(
+                [
+                    {"model": "Basic", "fields": ["<b>front</b>", "back"], "tags": ["a", " "]},
+                    {"model": "Basic", "fields": ["front", "back"], "tags": ["A", "b"]},
+                    {"model": "Basic", "fields": ["", "back"], "tags": []},  # no cards, so not added
+                ],
+                "Imported",
+            )
+            did = col.decks.by_name("Imported")["id"]
+
+            self.assertEqual(len(set(nids)), 3)
+            self.assertEqual(
+                col.db.execute(f"select id, tags, sfld from {username}.notes order by id").fetchall(),
+                [(nids[0], " a ", "front"), (nids[1], " a b ", "front")],
+            )
+            self.assertEqual(
+                col.db.execute(f"select nid, did, ord, due, type, queue from {username}.cards order by id").fetchall(),
+                [(nids[0], did, 0, 1, 0, 0), (nids[1], did, 0, 2, 0, 0)],
+            )
+            self.assertEqual(sorted(col.tags), ["A", "a", "b"])  # registered as given, like Note.flush does
+            self.assertTrue(col.basic_check())
+
+            self.assertEqual(self._create_queries(col, 2), self._create_queries(col, 100))
+
+
+class BasicCheckTest(TestRemoteServer):
+    def assets_package(self):
+        return "assets"
+
+    def test_basic_check(self):
+        username = self.user.username
+        with Collection(username, settings.DJANKISERV_DATA_ROOT) as col:
+            col.create_note({"model": "Basic", "fields": ["front", "back"], "tags": []}, "Default")
+            self.assertTrue(col.basic_check())
+
+            col.db.execute(f"update {username}.cards set ord = 5")
+            self.assertFalse(col.basic_check())  # the Basic model only has one template
+            col.db.execute(f"update {username}.cards set ord = 0")
+
+            nid = col.db.scalar(f"select id from {username}.notes")
+            col.db.execute(f"update {username}.cards set nid = 1")
+            self.assertFalse(col.basic_check())  # both orphaned cards and a note without cards
+            col.db.execute(f"update {username}.cards set nid = %s", nid)
+            self.assertTrue(col.basic_check())
+
+
+class MediaIngestTest(TestRemoteServer):
+    def assets_package(self):
+        return "assets"
+
+    @staticmethod
+    def media_zip(files, meta):
+        f = tempfile.TemporaryFile()
+        with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_STORED) as z:
+            for i, data in enumerate(files):
+                z.writestr(str(i), data)
+            z.writestr("_meta", json.dumps(meta))
+        f.seek(0)
+        return f
+
+    def test_adopt_media_changes_from_zip(self):
+        data = os.urandom(200 * 1024)
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            with zipfile.ZipFile(self.media_zip([data], [["big.png", "0"]])) as z:
+                self.assertEqual(col.adopt_media_changes_from_zip(z), 1)
+
+            self.assertEqual(
+                col.db.first(f"select csum from {col.username}.media where fname = 'big.png'")[0], checksum(data)
+            )
+            with open(os.path.join(col.media_dir(), "big.png"), "rb") as f:
+                self.assertEqual(f.read(), data)
+
+            f = self.media_zip([b"x" * 1000], [["bad.png", "0"]])
+            f.seek(100)
+            f.write(b"y")  # breaks the crc of the member
+            f.seek(0)
+            with zipfile.ZipFile(f) as z, self.assertRaises(zipfile.BadZipFile):
+                col.adopt_media_changes_from_zip(z)
+
+            self.assertEqual(os.listdir(col.media_dir()), ["big.png"])  # no partial file left behind
+
+
+class MediaDeleteTest(TestRemoteServer):
+    def assets_package(self):
+        return "assets"
+
+    def _delete_queries(self, col, count):
+        fnames = [f"{count}-{i}.png" for i in range(count)]
+        with zipfile.ZipFile(
+            MediaIngestTest.media_zip([f.encode() for f in fnames], [[f, str(i)] for i, f in enumerate(fnames)])
+        ) as z:
+            col.adopt_media_changes_from_zip(z)
+        usn = col.last_media_usn()
+        with CaptureQueriesContext(db_conn()) as queries:
+            col._remove_media_files(fnames + ["unknown.png"])  # pylint: disable=W0212
+
+        self.assertEqual(
+            col.db.execute(
+                f"select fname, usn, csum from {col.username}.media where usn > %s order by usn", usn
+            ).fetchall(),
+            [(f, usn + i, None) for i, f in enumerate(fnames + ["unknown.png"], 1)],
+        )
+        self.assertFalse(any(os.path.exists(os.path.join(col.media_dir(), f)) for f in fnames))
+        return len(queries)
+
+    def test_remove_media_files(self):
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            self.assertEqual(self._delete_queries(col, 2), self._delete_queries(col, 100))
+
+    def test_duplicate_and_unknown_names(self):
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            with zipfile.ZipFile(MediaIngestTest.media_zip([b"a", b"b"], [["a.png", "0"], ["b.png", "1"]])) as z:
+                col.adopt_media_changes_from_zip(z)
+            usn = col.last_media_usn()
+            meta = [["c.png", "0"], ["b.png", None], ["a.png", None], ["b.png", None], ["ghost.png", None]]
+            with zipfile.ZipFile(MediaIngestTest.media_zip([b"c"], meta)) as z:
+                self.assertEqual(col.adopt_media_changes_from_zip(z), len(meta))
+
+            self.assertEqual(
+                col.db.execute(f"select fname, usn, csum is null from {col.username}.media order by usn").fetchall(),
+                [
+                    ("b.png", usn + 1, True),
+                    ("a.png", usn + 2, True),
+                    ("ghost.png", usn + 3, True),
+                    ("c.png", usn + 4, False),
+                ],
+            )
+            self.assertEqual((col.last_media_usn(), col.media_count()), (usn + 4, 1))
+
+
+class MediaMetaTest(TestRemoteServer):
+    def assets_package(self):
+        return "assets"
+
+    def test_counters(self):
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            fnames = ["a.png", "b.png", "c.png"]
+            with zipfile.ZipFile(
+                MediaIngestTest.media_zip([b"a", b"b", b"c"], [[f, str(i)] for i, f in enumerate(fnames)])
+            ) as z:
+                col.adopt_media_changes_from_zip(z)
+            with zipfile.ZipFile(MediaIngestTest.media_zip([b"new a"], [["a.png", "0"], ["b.png", None]])) as z:
+                col.adopt_media_changes_from_zip(z)
+
+            self.assertEqual((col.last_media_usn(), col.media_count()), (5, 2))
+            self.assertEqual(Collection.repair_media_meta(col.db, col.username), (5, 2))
+
+    def test_upgrade_and_repair(self):
+        username = self.user.username
+        Collection(username, settings.DJANKISERV_DATA_ROOT).close()
+        db = StandardDB()
+        db.execute(f"alter table {username}.meta drop column mediacount")
+        db.execute(f"insert into {username}.media values ('a.png', 3, 'sum'), ('b.png', 4, null)")
+        StandardDB.forget_schema(username)  # as in a new process
+
+        with Collection(username, settings.DJANKISERV_DATA_ROOT) as col:
+            self.assertEqual((col.last_media_usn(), col.media_count()), (4, 1))
+
+        db.execute(f"update {username}.meta set lastusn = 0")
+        out = io.StringIO()
+        call_command("repair_media_meta", username, stdout=out)
+        self.assertIn(f"{username}: (usn, count) (0, 1) -> (4, 1)", out.getvalue())
+        self.assertEqual(tuple(db.first(f"select lastusn, mediacount from {username}.meta")), (4, 1))
+
+        # e.g. left by two concurrent repairs before they took a lock
+        db.execute(f"insert into {username}.meta (dirmod, lastusn, mediacount) values (0, 0, 0)")
+        self.assertEqual(Collection.repair_media_meta(db, username), (4, 1))
+        db.execute(f"delete from {username}.meta")
+        self.assertEqual(Collection.repair_media_meta(db, username), (4, 1))
+        self.assertEqual(db.execute(f"select lastusn, mediacount from {username}.meta").fetchall(), [(4, 1)])
+
+        # the column gets added by another process after this one checked
+        existing = StandardDB.existing_columns(username) - {("meta", "mediacount")}
+        StandardDB.forget_schema(username)
+        with mock.patch.object(StandardDB, "existing_columns", return_value=existing):
+            StandardDB.upgrade_schema(username)
+        self.assertIn(("meta", "mediacount"), StandardDB.existing_columns(username))
+
+
+@override_settings(DJANKISERV_MEDIA_DEDUP=True)
+class MediaStoreTest(TestRemoteServer):
+    store = MediaStore(os.path.join(settings.DJANKISERV_DATA_ROOT, MediaStore.DIRNAME))
+
+    def assets_package(self):
+        return "assets"
+
+    def test_shared_media(self):
+        other = User.objects.create_user(username="another_username", password="a_pass_word")
+        self.addCleanup(other.delete)
+        data = os.urandom(1000)
+        blob = self.store.blob_path(checksum(data))
+
+        cols = [Collection(u.username, settings.DJANKISERV_DATA_ROOT) for u in (self.user, other)]
+        for col in cols:
+            with zipfile.ZipFile(MediaIngestTest.media_zip([data], [["shared.png", "0"]])) as z:
+                col.adopt_media_changes_from_zip(z)
+            self.assertTrue(os.path.samefile(os.path.join(col.media_dir(), "shared.png"), blob))
+        self.assertEqual(os.stat(blob).st_nlink, 3)
+
+        cols[0].media_sync_delete("shared.png")
+        self.assertEqual(os.stat(blob).st_nlink, 2)
+        with zipfile.ZipFile(MediaIngestTest.media_zip([b"changed"], [["shared.png", "0"]])) as z:
+            cols[1].adopt_media_changes_from_zip(z)  # overwrites the only remaining user of the blob
+        self.assertFalse(os.path.exists(blob))
+        with open(os.path.join(cols[1].media_dir(), "shared.png"), "rb") as f:
+            self.assertEqual(f.read(), b"changed")
+        for col in cols:
+            col.close()
+
+    def test_delete_after_full_upload(self):
+        data = os.urandom(1000)
+        blob = self.store.blob_path(checksum(data))
+        with Collection(self.user.username, settings.DJANKISERV_DATA_ROOT) as col:
+            with zipfile.ZipFile(MediaIngestTest.media_zip([data], [["a.png", "0"]])) as z:
+                col.adopt_media_changes_from_zip(z)
+            col.db.execute(f"delete from {col.username}.media")  # as a full upload does, keeping the media files
+        self.assertTrue(os.path.exists(blob))
+
+        Collection.delete(self.user.username, settings.DJANKISERV_DATA_ROOT)
+        self.assertFalse(os.path.exists(blob))
+
+    def test_dedup_media_command(self):
+        for username in ("user1", "user2"):
+            os.makedirs(os.path.join(settings.DJANKISERV_DATA_ROOT, username))
+            with open(os.path.join(settings.DJANKISERV_DATA_ROOT, username, "a.png"), "wb") as f:
+                f.write(b"same content")
+            self.addCleanup(shutil.rmtree, os.path.join(settings.DJANKISERV_DATA_ROOT, username))
+
+        call_command("dedup_media", "user1", "user2", stdout=io.StringIO())
+        self.assertTrue(
+            os.path.samefile(
+                os.path.join(settings.DJANKISERV_DATA_ROOT, "user1", "a.png"),
+                os.path.join(settings.DJANKISERV_DATA_ROOT, "user2", "a.png"),
+            )
+        )
+
+        os.remove(os.path.join(settings.DJANKISERV_DATA_ROOT, "user1", "a.png"))
+        os.remove(os.path.join(settings.DJANKISERV_DATA_ROOT, "user2", "a.png"))
+        call_command("dedup_media", "user1", stdout=io.StringIO())
+        self.assertFalse(os.path.exists(self.store.blob_path(checksum(b"same content"))))